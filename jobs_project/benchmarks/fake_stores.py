@@ -0,0 +1,145 @@
+import time
+from unittest import mock
+from jobs_project.metrics import Metrics, timed
+from database_managers import redis_manager, resources
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class FakeCursor:
+    def __init__(self):
+        self.rowcount = 0
+
+
+class FakePostgreSQLManager:
+    """In-memory replacement of PostgreSQLManager with the methods the spider and the pipeline use.
+
+    The rows are shared by every instance, like a real table, so the identifiers written in one
+    benchmark cycle are loaded again by the spider of the next one. Every call sleeps for
+    `latency` seconds to stand in for a network round trip."""
+
+    tables = {}
+    generations = {}
+    latency = 0.0
+
+    def __init__(self, settings=None, metrics=None):
+        self.metrics = metrics or Metrics()
+        # Each site of a multi-site run has its own table
+        self.table_name = (settings.get('POSTGRES_TABLE_NAME') if settings else None) or 'raw_table'
+        self.cursor = FakeCursor()
+        self.connection = None
+
+    @classmethod
+    def reset(cls):
+        cls.tables = {}
+        cls.generations = {}
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def connect(self):
+        pass
+
+    def ensure_connection(self):
+        return True
+
+    def create_table(self, create_table_query):
+        self.round_trip()
+        self.tables.setdefault(self.table_name, {})
+
+    def add_column_if_not_exists(self, column_name, column_type):
+        self.round_trip()
+
+    def create_unique_index(self, column_name):
+        self.round_trip()
+
+    def create_generation_counter(self):
+        self.round_trip()
+        self.generations.setdefault(self.table_name, 0)
+
+    def bump_generation(self):
+        if self.table_name in self.generations:
+            self.generations[self.table_name] += 1
+
+    @timed('postgresql_read_seconds')
+    def fetch_generation(self):
+        self.round_trip()
+        if self.table_name not in self.generations:
+            return None
+        return f"fake:{self.generations[self.table_name]}"
+
+    def execute_query(self, query, values=None):
+        self.round_trip()
+        # Only the table existence check reads the row count
+        self.cursor.rowcount = 1 if 'information_schema' in query and self.table_name in self.tables else 0
+
+    @timed('postgresql_write_seconds')
+    def upsert_many_values(self, values_list, conflict_column='job_identifier'):
+        self.round_trip()
+        rows = self.tables.setdefault(self.table_name, {})
+        for values in values_list:
+            rows[values[conflict_column]] = dict(values)
+        self.bump_generation()
+        return 0
+
+    @timed('postgresql_write_seconds')
+    def upsert_many_rows(self, columns, rows, conflict_column='job_identifier'):
+        self.round_trip()
+        table = self.tables.setdefault(self.table_name, {})
+        conflict_index = list(columns).index(conflict_column)
+        for row in rows:
+            table[row[conflict_index]] = dict(zip(columns, row))
+        self.bump_generation()
+        return 0
+
+    @timed('postgresql_delete_seconds')
+    def delete_rows_with_identifiers(self, identifiers):
+        self.round_trip()
+        rows = self.tables.get(self.table_name, {})
+        self.cursor.rowcount = sum(rows.pop(identifier, None) is not None for identifier in identifiers)
+        self.bump_generation()
+        return True
+
+    def stream_values(self, query, chunk_size=5000, values=None):
+        # The spider only reads the identifiers and fingerprints of the stored jobs
+        with self.metrics.timer('postgresql_read_seconds', operation='stream_values'):
+            self.round_trip()
+            rows = [(identifier, row.get('content_hash')) for identifier, row in self.tables.get(self.table_name, {}).items()]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def close_connection(self):
+        pass
+
+
+def install_fake_stores(latency=0.0):
+    # Replace the three databases with in-process fakes and return the patches to stop later.
+    # Redis and MongoDB keep their real managers, only their clients are swapped
+    if fakeredis is None or mongomock is None:
+        raise RuntimeError("The fake stores need the fakeredis and mongomock packages")
+
+    FakePostgreSQLManager.reset()
+    FakePostgreSQLManager.latency = latency
+
+    # Every client has to see the same data, so they all share one server and one Mongo client
+    redis_server = fakeredis.FakeServer()
+    mongo_client = mongomock.MongoClient()
+
+    patches = [
+        mock.patch.object(resources.DatabaseResources, 'postgresql_manager', lambda self, settings=None, metrics=None: FakePostgreSQLManager(settings or self.settings, metrics)),
+        mock.patch.object(resources, 'MongoClient', lambda *args, **kwargs: mongo_client),
+        mock.patch.object(redis_manager.redis, 'StrictRedis', lambda *args, **kwargs: fakeredis.FakeStrictRedis(server=redis_server)),
+    ]
+    for patch in patches:
+        patch.start()
+    return patches
+
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockJobsAPI:
+    """Local stand-in for the careers.fedex.com /api/jobs endpoint serving synthetic paginated jobs.
+
+    Every job has a slot on a page. Between crawl cycles a share of the slots gets a new
+    job (churn: one job closes and another one is posted) and another share gets an updated
+    description, so repeated cycles exercise the dedup, update and sweep paths. With repost_rate
+    a share of the slots gets back the job they had before their last churn, a closed job posted
+    again under the same req_id. A share of the requests can be answered with 500 (error_rate)
+    or 429 (throttle_rate) responses. With etag every page carries an ETag and a matching
+    If-None-Match is answered with 304."""
+
+    def __init__(self, pages=50, page_size=10, job_size=2000, latency=0.0, churn=0.0, update_rate=0.0, featured=3, seed=0,
+                 error_rate=0.0, throttle_rate=0.0, etag=True, repost_rate=0.0):
+        self.pages = pages
+        self.page_size = page_size
+        self.job_size = job_size
+        self.latency = latency
+        self.churn = churn
+        self.update_rate = update_rate
+        self.repost_rate = repost_rate
+        self.featured = featured
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.etag = etag
+        self.not_modified = 0
+        self.failures = 0
+        self.random = random.Random(seed)
+        # Generation of the job in each slot and the version of its content
+        self.generations = [0] * (pages * page_size)
+        self.versions = [0] * (pages * page_size)
+        self.requests = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def total_count(self):
+        return len(self.generations)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/api/jobs"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.requests += 1
+                query = parse_qs(urlparse(self.path).query)
+                page = int(query.get('page', ['1'])[0])
+                featured = query.get('featured', ['false'])[0] == 'true'
+                if api.latency:
+                    time.sleep(api.latency)
+                status = api.failure_status()
+                if status:
+                    self.send_response(status)
+                    if status == 429:
+                        self.send_header('Retry-After', '1')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps(api.page_body(page, featured)).encode('utf-8')
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if api.etag and self.headers.get('If-None-Match') == etag:
+                    api.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if api.etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def failure_status(self):
+        draw = self.random.random()
+        if draw < self.throttle_rate:
+            status = 429
+        elif draw < self.throttle_rate + self.error_rate:
+            status = 500
+        else:
+            return None
+        self.failures += 1
+        return status
+
+    def next_cycle(self):
+        # Close and post jobs, post again jobs closed before, update the content of others
+        reposted = [slot for slot, generation in enumerate(self.generations) if generation > 0]
+        for slot in self.random.sample(reposted, min(int(self.total_count * self.repost_rate), len(reposted))):
+            self.generations[slot] -= 1
+            self.versions[slot] = 0
+        for slot in self.random.sample(range(self.total_count), int(self.total_count * self.churn)):
+            self.generations[slot] += 1
+            self.versions[slot] = 0
+        for slot in self.random.sample(range(self.total_count), int(self.total_count * self.update_rate)):
+            self.versions[slot] += 1
+
+    def page_body(self, page, featured):
+        if featured:
+            slots = range(min(self.featured, self.total_count))
+        else:
+            start = (page - 1) * self.page_size
+            slots = range(max(start, 0), min(start + self.page_size, self.total_count))
+        return {'jobs': [self.job(slot) for slot in slots], 'totalCount': self.total_count}
+
+    def job(self, slot):
+        generation = self.generations[slot]
+        version = self.versions[slot]
+        req_id = f"R{slot:06d}-{generation}"
+        return {
+            'data': {
+                'slug': req_id.lower(),
+                'language': 'en-us',
+                'languages': ['en-us'],
+                'req_id': req_id,
+                'title': f"Package Handler {slot}",
+                'description': f"Version {version}. " + 'x' * self.job_size,
+                'location_name': f"Hub {slot % 97}",
+                'street_address': f"{slot} Main Street",
+                'city': 'Memphis',
+                'state': 'Tennessee',
+                'country': 'United States',
+                'country_code': 'US',
+                'postal_code': '38118',
+                'location_type': 'ADDRESS',
+                'latitude': 35.04,
+                'longitude': -89.97,
+                'tags': ['Operations', 'Full-Time'],
+                'tags5': [],
+                'tags6': [],
+                'brand': 'FedEx Ground',
+                'promotion_value': 0,
+                'salary_currency': 'USD',
+                'salary_value': 0,
+                'salary_min_value': 0,
+                'salary_max_value': 0,
+                'employment_type': 'FULL_TIME',
+                'hiring_organization': 'FedEx',
+                'source': 'Taleo',
+                'apply_url': f"https://example.com/apply/{req_id}",
+                'internal': False,
+                'searchable': True,
+                'applyable': True,
+                'li_easy_applyable': False,
+                'meta_data': {
+                    'login_url': 'https://example.com/login',
+                    'region_description': 'Americas',
+                    'site_id': 'fedex',
+                    'googlejobs': {
+                        'companyName': 'FedEx',
+                        'jobName': f"jobs/{req_id}",
+                        'derivedInfo': {
+                            'jobCategories': ['TRANSPORTATION'],
+                            'locations': [{'latLng': {'latitude': 35.04, 'longitude': -89.97}}],
+                        },
+                        'jobSummary': 'Summary',
+                        'jobTitleSnippet': 'Package Handler',
+                        'searchTextSnippet': 'Package',
+                    },
+                    'canonical_url': f"https://example.com/jobs/{req_id}",
+                    'last_mod': '2024-01-01T00:00:00',
+                    'gdpr': False,
+                },
+                'update_date': '2024-01-01T00:00:00+0000',
+                'create_date': '2024-01-01T00:00:00+0000',
+                'category': 'Operations',
+                'full_location': 'Memphis, Tennessee',
+                'short_location': 'Memphis, TN',
+            }
+        }
@@ -0,0 +1,223 @@
+"""Offline crawl benchmark.
+
+Runs JobSpider and PostgreSQLMongoDBPipeline against a local mock of the jobs API for a number
+of crawl cycles and reports pages/s, items/s, database round trips per item and peak RSS.
+Run it from the jobs_project directory:
+
+    python -m benchmarks.run_benchmark --pages 200 --cycles 3 --churn 0.05 --update-rate 0.05
+
+By default Redis, PostgreSQL and MongoDB are replaced with in-process fakes (fakeredis,
+mongomock and an in-memory table). With --stores local the databases configured in the
+environment are used instead, like a normal crawl.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+# The settings module reads these at import time, the fake stores do not need real values
+for name, value in (('POSTGRES_PORT', '5432'), ('MONGO_PORT', '27017'), ('REDIS_PORT', '6379'),
+                    ('POSTGRES_TABLE_NAME', 'raw_table'), ('MONGO_DB', 'jobs'), ('MONGO_COLLECTION_NAME', 'raw_collection'),
+                    ('METRICS_JSON_FILE', ''), ('METRICS_PROMETHEUS_FILE', '')):
+    os.environ.setdefault(name, value)
+os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'jobs_project.settings')
+
+from scrapy.utils.reactor import install_reactor
+
+install_reactor('twisted.internet.selectreactor.SelectReactor')
+
+from twisted.internet import defer, reactor
+from scrapy.crawler import Crawler, CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from jobs_project.sites import SiteConfig
+from jobs_project.spiders.job_spider import JobSpider
+from benchmarks.mock_jobs_api import MockJobsAPI
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the crawl against a local mock of the jobs API")
+    parser.add_argument('--pages', type=int, default=50, help="number of regular pages")
+    parser.add_argument('--page-size', type=int, default=10, help="jobs per page")
+    parser.add_argument('--job-size', type=int, default=2000, help="length of the job description in characters")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the API waits before every response")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="seconds every fake PostgreSQL call waits")
+    parser.add_argument('--churn', type=float, default=0.0, help="share of the jobs replaced between cycles")
+    parser.add_argument('--repost-rate', type=float, default=0.0, help="share of the jobs closed in an earlier cycle posted again")
+    parser.add_argument('--update-rate', type=float, default=0.0, help="share of the jobs updated between cycles")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of the API requests answered with 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of the API requests answered with 429")
+    parser.add_argument('--no-etag', action='store_true', help="the API sends no ETag, unchanged pages are found by their body hash")
+    parser.add_argument('--cycles', type=int, default=2, help="number of crawls, the first one starts from empty stores")
+    parser.add_argument('--sites', type=int, default=1, help="career sites crawled together, each one served by its own mock API")
+    parser.add_argument('--workers', type=int, default=1, help="spiders sharing every cycle through the Redis queue (CRAWL_DISTRIBUTED)")
+    parser.add_argument('--no-spool', action='store_true', help="write the items straight to the stores instead of through the spool")
+    parser.add_argument('--dedup', choices=('redis', 'sqlite'), default='redis', help="dedup backend of the spider")
+    parser.add_argument('--stores', choices=('fake', 'local'), default='fake', help="in-process fakes or the configured databases")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def round_trips(summaries):
+    # Every call of a timed database manager method is one round trip
+    counts = {}
+    for histogram in (histogram for summary in summaries for histogram in summary['histograms']):
+        name = histogram['name']
+        if name.startswith(('redis_', 'postgresql_', 'mongodb_')):
+            store = name.split('_')[0]
+            counts[store] = counts.get(store, 0) + histogram['count']
+    return counts
+
+
+def stats_sum(crawlers, name):
+    return sum(crawler.stats.get_value(name, 0) for crawler in crawlers)
+
+
+def cycle_result(cycle, crawlers, elapsed_time):
+    # Every crawler has its own metrics, the cycle adds up those of all of them
+    summaries = [crawler.metrics.to_dict() for crawler in crawlers]
+    counters = [counter for summary in summaries for counter in summary['counters']]
+    items = stats_sum(crawlers, 'item_scraped_count')
+    pages = stats_sum(crawlers, 'response_received_count')
+    jobs_seen = sum(counter['value'] for counter in counters if counter['name'] == 'jobs_seen')
+    pages_unchanged = sum(counter['value'] for counter in counters if counter['name'] == 'pages_unchanged')
+    trips = round_trips(summaries)
+    return {
+        'cycle': cycle,
+        'seconds': elapsed_time,
+        'pages': pages,
+        'items': items,
+        'jobs_seen': jobs_seen,
+        'pages_unchanged': pages_unchanged,
+        'pages_per_second': pages / elapsed_time if elapsed_time else 0.0,
+        'items_per_second': items / elapsed_time if elapsed_time else 0.0,
+        'retries': stats_sum(crawlers, 'retry/count'),
+        # Events published to the change feed
+        'changes': {event_type: stats_sum(crawlers, f"change_feed/{event_type}") for event_type in ('added', 'updated', 'removed')},
+        # Only the worker that finished the last shard sweeps
+        'sweep': {key[len('sweep/'):]: value for crawler in crawlers
+                  for key, value in crawler.stats.get_stats().items() if key.startswith('sweep/')},
+        'api_concurrency': [crawler.stats.get_value('api_throttle/concurrency') for crawler in crawlers],
+        'pages_per_worker': [crawler.stats.get_value('response_received_count', 0) for crawler in crawlers],
+        'round_trips': trips,
+        # Per scraped item, and per job seen for the cycles where nothing changed
+        'round_trips_per_item': sum(trips.values()) / items if items else None,
+        'round_trips_per_job_seen': sum(trips.values()) / jobs_seen if jobs_seen else None,
+    }
+
+
+def peak_rss_megabytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+
+@defer.inlineCallbacks
+def run_cycles(arguments, apis, results):
+    settings = get_project_settings()
+    settings.set('LOG_LEVEL', 'WARNING')
+    if arguments.dedup == 'sqlite':
+        # A new file for every benchmark, kept across its cycles
+        settings.set('DEDUP_BACKEND', 'jobs_project.dedup.SQLiteDedupBackend')
+        settings.set('DEDUP_SQLITE_PATH', os.path.join(tempfile.mkdtemp(), 'job_identifiers.sqlite3'))
+    if arguments.no_spool:
+        settings.set('SPOOL_ENABLED', False)
+    else:
+        settings.set('SPOOL_DIR', os.path.join(tempfile.mkdtemp(), 'spool'))
+    settings.set('CHANGE_FEED_PATH', os.path.join(tempfile.mkdtemp(), 'job_changes.ndjson'))
+    if arguments.workers > 1:
+        settings.set('CRAWL_DISTRIBUTED', True)
+        # The workers share the Redis Stream feed, fakeredis has no streams so the fakes go without a feed
+        settings.set('CHANGE_FEED_BACKEND', 'jobs_project.changes.RedisStreamChangeFeed' if arguments.stores == 'local' else '')
+    runner = CrawlerRunner(settings)
+    # A single API is crawled like the default site, several like the sites of a SITES_FILE
+    sites = [None]
+    if len(apis) > 1:
+        sites = [SiteConfig(f"site{index}", base_url=f"{api.url}?page=1&featured=true", page_url=f"{api.url}?page={{}}&featured=false")
+                 for index, api in enumerate(apis)]
+    try:
+        for cycle in range(1, arguments.cycles + 1):
+            if cycle > 1:
+                for api in apis:
+                    api.next_cycle()
+            start_time = time.perf_counter()
+            crawls = []
+            crawlers = []
+            for site, api in zip(sites, apis):
+                for worker in range(arguments.workers):
+                    crawler_settings = site.crawler_settings(settings) if site else settings.copy()
+                    # The workers share a process, each one needs its own id for its leases and its spool
+                    if arguments.workers > 1:
+                        crawler_settings.set('CRAWL_WORKER_ID', f"worker{worker}")
+                    crawler = Crawler(JobSpider, crawler_settings)
+                    crawlers.append(crawler)
+                    crawls.append(runner.crawl(
+                        crawler,
+                        base_url=f"{api.url}?page=1&featured=true",
+                        page_url=f"{api.url}?page={{}}&featured=false",
+                    ))
+            yield defer.DeferredList(crawls)
+            result = cycle_result(cycle, crawlers, time.perf_counter() - start_time)
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        reactor.stop()
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    configure_logging({'LOG_LEVEL': 'WARNING'})
+
+    patches = []
+    if arguments.stores == 'fake':
+        from benchmarks.fake_stores import install_fake_stores
+        patches = install_fake_stores(latency=arguments.db_latency)
+
+    apis = [
+        MockJobsAPI(
+            pages=arguments.pages,
+            page_size=arguments.page_size,
+            job_size=arguments.job_size,
+            latency=arguments.latency,
+            churn=arguments.churn,
+            update_rate=arguments.update_rate,
+            repost_rate=arguments.repost_rate,
+            seed=arguments.seed + index,
+            error_rate=arguments.error_rate,
+            throttle_rate=arguments.throttle_rate,
+            etag=not arguments.no_etag,
+        ).start()
+        for index in range(arguments.sites)
+    ]
+
+    results = []
+    try:
+        reactor.callWhenRunning(run_cycles, arguments, apis, results)
+        reactor.run()
+    finally:
+        for api in apis:
+            api.stop()
+        for patch in patches:
+            patch.stop()
+
+    report = {
+        'parameters': vars(arguments),
+        'cycles': results,
+        'api_requests': sum(api.requests for api in apis),
+        'api_failures': sum(api.failures for api in apis),
+        'api_not_modified': sum(api.not_modified for api in apis),
+        'peak_rss_mb': peak_rss_megabytes(),
+    }
+    print(f"peak RSS: {report['peak_rss_mb']:.1f} MB")
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
 from scrapy.utils.project import get_project_settings
+from jobs_project.metrics import Metrics, timed
 
 class MongoDBManager:
-    def __init__(self):
-        settings = get_project_settings()
+    def __init__(self, settings=None, client=None, metrics=None):
+        settings = settings or get_project_settings()
         self.collection_name = settings.get('MONGO_COLLECTION_NAME')
         self.db_settings = {
             'host': settings.get('MONGO_HOST'),
@@ -12,7 +14,11 @@ class MongoDBManager:
             'user': settings.get('MONGO_USERNAME'),
             'password': settings.get('MONGO_PASSWORD'),
         }
-        self.mongo_client = None
+        self.mongo_client = client
+        # A client handed in is shared with other managers and is not closed by this one
+        self.owns_client = client is None
+        # The calls are timed in the metrics of the crawl using the manager
+        self.metrics = metrics or Metrics()
         self.mongo_db = None
         self.mongo_collection = None
 
@@ -22,14 +28,16 @@ class MongoDBManager:
     def connect(self):
         # Connect to MongoDB
         try:
-            self.mongo_uri = f"mongodb://{self.db_settings['user']}:{self.db_settings['password']}@{self.db_settings['host']}:{self.db_settings['port']}"
-            self.mongo_client = MongoClient(self.mongo_uri)
+            if self.owns_client:
+                self.mongo_uri = f"mongodb://{self.db_settings['user']}:{self.db_settings['password']}@{self.db_settings['host']}:{self.db_settings['port']}"
+                self.mongo_client = MongoClient(self.mongo_uri)
             self.mongo_db = self.mongo_client[self.db_settings['database']]
             self.mongo_collection = self.mongo_db[self.collection_name]
         except Exception as e:
             # Handle the connection error
             print(f"Error connecting to MongoDB: {e}")
 
+    @timed('mongodb_write_seconds')
     def insert_values(self, values):
         try:
             self.mongo_collection.insert_one(values)
@@ -37,6 +45,56 @@ class MongoDBManager:
             # Handle the insertion error
             print(f"Failed to insert item into MongoDB. Error: {e}")
 
+    @timed('mongodb_write_seconds')
+    def upsert_many_values(self, values_list, key='job_identifier'):
+        # Returns the number of documents that could not be written. Connection errors are
+        # raised, the caller can write the same documents again once MongoDB is back
+        if not values_list:
+            return 0
+        try:
+            # Replace the stored document with the same key or insert a new one. Unordered, so the
+            # server keeps writing the remaining documents when one of them fails
+            requests = [ReplaceOne({key: values[key]}, values, upsert=True) for values in values_list]
+            self.mongo_collection.bulk_write(requests, ordered=False)
+            return 0
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            print(f"Failed to write {len(write_errors)} of {len(values_list)} items into MongoDB. Error: {write_errors[:1]}")
+            return len(write_errors)
+        except ConnectionFailure as e:
+            print(f"Failed to reach MongoDB. Error: {e}")
+            raise
+        except Exception as e:
+            # Handle the insertion error
+            print(f"Failed to write batch into MongoDB. Error: {e}")
+            return len(values_list)
+
+    @timed('mongodb_delete_seconds')
+    def delete_documents_with_identifiers(self, identifiers):
+        try:
+            return self.mongo_collection.delete_many({'job_identifier': {'$in': identifiers}}).deleted_count
+        except Exception as e:
+            print(f"Failed to delete items from MongoDB. Error: {e}")
+            return None
+
+    def create_unique_index(self, key):
+        index_name = f"{key}_unique"
+        try:
+            if index_name in self.mongo_collection.index_information():
+                return
+
+            # Collections written before the index existed may contain duplicates, keep the newest document of each
+            duplicates = self.mongo_collection.aggregate([
+                {'$group': {'_id': f"${key}", 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gt': 1}}},
+            ], allowDiskUse=True)
+            for duplicate in duplicates:
+                self.mongo_collection.delete_many({'_id': {'$in': sorted(duplicate['ids'])[:-1]}})
+
+            self.mongo_collection.create_index(key, unique=True, name=index_name)
+        except Exception as e:
+            print(f"Failed to create the unique index on {key} in MongoDB. Error: {e}")
+
     def close_connection(self):
-        if self.mongo_client:
+        if self.mongo_client and self.owns_client:
             self.mongo_client.close()
@@ -1,9 +1,11 @@
 import psycopg2
+from psycopg2.extras import execute_values
 from scrapy.utils.project import get_project_settings
+from jobs_project.metrics import Metrics, timed
 
 class PostgreSQLManager:
-    def __init__(self):
-        settings = get_project_settings()
+    def __init__(self, settings=None, pool=None, metrics=None):
+        settings = settings or get_project_settings()
         self.table_name = settings.get('POSTGRES_TABLE_NAME')
         self.db_settings = {
             'host': settings.get('POSTGRES_HOST'),
@@ -14,56 +16,192 @@ class PostgreSQLManager:
         }
         self.connection = None
         self.cursor = None
+        # Connections are borrowed from the pool when there is one and given back on close
+        self.pool = pool
+        # The calls are timed in the metrics of the crawl using the manager
+        self.metrics = metrics or Metrics()
         # Connect to the database
         self.connect()
                     
     def connect(self):
         try:
-            self.connection = psycopg2.connect(**self.db_settings)
+            if self.pool:
+                self.connection = self.pool.getconn()
+            else:
+                self.connection = psycopg2.connect(**self.db_settings)
             self.cursor = self.connection.cursor()
         except psycopg2.Error as e:
             # Handle the connection error
             print(f"Error connecting to PostgreSQL: {e}")
+
+    def ensure_connection(self):
+        # Connects again when there is no connection or the server closed it, returns whether there is one now
+        if self.connection is not None and self.connection.closed:
+            if self.pool:
+                self.pool.putconn(self.connection, close=True)
+            self.connection = None
+        if self.connection is None:
+            self.connect()
+        return self.connection is not None
         
         
     def create_table(self, create_table_query):
         self.cursor.execute(create_table_query)
         self.connection.commit()
+
+    def add_column_if_not_exists(self, column_name, column_type):
+        # Bring tables created by older versions up to date
+        self.execute_query(f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS {column_name} {column_type}")
          
-    def insert_values(self, values):
-        insert_query = """
+    def upsert_query(self, columns, values_clause, conflict_column):
+        # Insert the row, or overwrite the stored row when one with the same conflict_column value exists
+        update_columns = [column for column in columns if column != conflict_column]
+        return """
             INSERT INTO {table_name} (
                 {columns}
-            ) VALUES (
-                {values}
-            )
+            ) VALUES {values_clause}
+            ON CONFLICT ({conflict_column}) DO {action}
         """.format(
             table_name = self.table_name,
-            columns=', '.join(values.keys()),
-            values=', '.join('%({})s'.format(key) for key in values.keys())
+            columns=', '.join(columns),
+            values_clause=values_clause,
+            conflict_column=conflict_column,
+            action='UPDATE SET ' + ', '.join(f"{column} = EXCLUDED.{column}" for column in update_columns) if update_columns else 'NOTHING'
         )
-        
-        self.execute_query(insert_query,values)
+
+    @timed('postgresql_write_seconds')
+    def upsert_values(self, values, conflict_column='job_identifier'):
+        values_clause = '({})'.format(', '.join('%({})s'.format(key) for key in values.keys()))
+        return self.execute_query(self.upsert_query(list(values.keys()), values_clause, conflict_column), values)
+
+    def upsert_many_values(self, values_list, conflict_column='job_identifier'):
+        # Rows may have different keys, so use the union of them as the column list.
+        # Missing values are written as NULL, which is the column default anyway
+        columns = list(dict.fromkeys(key for values in values_list for key in values.keys()))
+        rows = [tuple(values.get(column) for column in columns) for values in values_list]
+        return self.upsert_many_rows(columns, rows, conflict_column)
+
+    @timed('postgresql_write_seconds')
+    def upsert_many_rows(self, columns, rows, conflict_column='job_identifier'):
+        # Insert or update a batch of rows, tuples in the order of columns, with a single statement
+        # and a single commit. Returns the number of rows that could not be written
+        if not rows:
+            return 0
+        if not self.ensure_connection():
+            return len(rows)
+
+        # A single statement can not update the same row twice, so only the last version of a row is kept
+        conflict_index = list(columns).index(conflict_column)
+        rows = list({row[conflict_index]: row for row in rows}.values())
+        upsert_query = self.upsert_query(columns, '%s', conflict_column)
+
+        try:
+            execute_values(self.cursor, upsert_query, rows, page_size=len(rows))
+            self.connection.commit()
+            return 0
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            print(f"Failed to write batch of {len(rows)} items into PostgreSQL, retrying one by one. Error: {e}")
+
+        # Fall back to one statement per row so that a single bad row does not lose the whole batch
+        failed_rows = 0
+        for row in rows:
+            if not self.upsert_values(dict(zip(columns, row)), conflict_column):
+                failed_rows += 1
+        return failed_rows
+
+    def create_unique_index(self, column_name):
+        index_name = f"{self.table_name}_{column_name}_key"
+        self.execute_query("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s", (self.table_name, index_name))
+        if self.cursor.rowcount:
+            return
+
+        # Tables written before the index existed may contain duplicates, keep the newest row of each
+        self.execute_query("""
+            DELETE FROM {table_name} AS older USING {table_name} AS newer
+            WHERE older.{column_name} = newer.{column_name} AND older.id < newer.id
+        """.format(table_name=self.table_name, column_name=column_name))
+        self.execute_query(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {self.table_name} ({column_name})")
+
+    @timed('postgresql_delete_seconds')
+    def delete_rows_with_identifiers(self, identifiers):
+        delete_query = """
+            DELETE FROM {table_name}
+            WHERE job_identifier = ANY(%s)
+        """.format(table_name=self.table_name)
+        return self.execute_query(delete_query, (identifiers,))
     
-    def fetch_values(self,query):
-        self.execute_query(query)
-        return self.cursor.fetchall()
+    def stream_values(self, query, chunk_size=5000, values=None):
+        # A named cursor lives on the server, so the rows are fetched chunk_size at a time
+        # instead of loading the whole result into memory. Yields lists of rows
+        if not self.connection:
+            self.connect()
+        with self.connection.cursor(name=f"{self.table_name}_stream") as cursor:
+            cursor.execute(query, values)
+            while True:
+                with self.metrics.timer('postgresql_read_seconds', operation='stream_values'):
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        self.connection.commit()
+
+    def create_generation_counter(self):
+        # Every statement that changes the table bumps its generation, so a copy of the table
+        # elsewhere (the identifiers in Redis) can tell whether it is still up to date.
+        # The token is random per table, a recreated table never matches a copy of the old one
+        generation_table = f"{self.table_name}_generation"
+        self.execute_query("SELECT 1 FROM pg_trigger WHERE tgname = %s", (f"{generation_table}_bump",))
+        if self.cursor.rowcount:
+            return
+        self.execute_query("""
+            CREATE TABLE IF NOT EXISTS {generation_table} (token TEXT NOT NULL, generation BIGINT NOT NULL);
+            INSERT INTO {generation_table} (token, generation)
+                SELECT md5(random()::text), 0 WHERE NOT EXISTS (SELECT 1 FROM {generation_table});
+            CREATE OR REPLACE FUNCTION {generation_table}_bump() RETURNS trigger AS $$
+            BEGIN
+                UPDATE {generation_table} SET generation = generation + 1;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS {generation_table}_bump ON {table_name};
+            CREATE TRIGGER {generation_table}_bump AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table_name}
+                FOR EACH STATEMENT EXECUTE PROCEDURE {generation_table}_bump();
+        """.format(table_name=self.table_name, generation_table=generation_table))
+
+    @timed('postgresql_read_seconds')
+    def fetch_generation(self):
+        # Current generation of the table as 'token:generation', None when there is no counter
+        if not self.execute_query(f"SELECT token || ':' || generation FROM {self.table_name}_generation"):
+            return None
+        row = self.cursor.fetchone()
+        return row[0] if row else None
     
             
     def execute_query(self, query, values=None):
         # Execute a query on the PostgreSQL database
-        if not self.connection:
-            self.connect()
+        if not self.ensure_connection():
+            return False
         try:
             self.cursor.execute(query, values)
             self.connection.commit()
+            return True
         except psycopg2.Error as e:
             self.connection.rollback()
-            print(f"Failed to insert item into PostgreSQL. Error: {e}")
+            print(f"Failed to execute query on PostgreSQL. Error: {e}")
+            return False
 
 
     def close_connection(self):
-        self.connection.commit()
-        self.connection.close()
+        if not self.connection:
+            return
+        if self.pool:
+            # The pool rolls back anything left open, and drops the connection if it is broken
+            self.cursor.close()
+            self.pool.putconn(self.connection, close=bool(self.connection.closed))
+        else:
+            self.connection.commit()
+            self.connection.close()
+        self.connection = None
 
 
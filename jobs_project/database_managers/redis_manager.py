@@ -1,13 +1,18 @@
 import redis
 from scrapy.utils.project import get_project_settings
+from jobs_project.metrics import Metrics, timed
 
 class RedisManager:
-    def __init__(self):
-        settings = get_project_settings()
+    def __init__(self, settings=None, connection_pool=None, metrics=None):
+        settings = settings or get_project_settings()
         self.host = settings.get('REDIS_HOST')
         self.port = settings.get('REDIS_PORT')
         self.db = settings.get('REDIS_DB')
         self.connection = None
+        # Connections of a shared pool are reused by every manager of the pool
+        self.connection_pool = connection_pool
+        # The calls are timed in the metrics of the crawl using the manager
+        self.metrics = metrics or Metrics()
 
         # Connect to Redis
         self.connect()
@@ -15,37 +20,37 @@ class RedisManager:
     def connect(self):
         """Establish a connection to the Redis database."""
         try:
-            self.connection = redis.StrictRedis(host=self.host, port=self.port, db=self.db)
+            if self.connection_pool:
+                self.connection = redis.StrictRedis(connection_pool=self.connection_pool)
+            else:
+                self.connection = redis.StrictRedis(host=self.host, port=self.port, db=self.db)
         except Exception as e:
             # Handle the connection error
             print(f"Error connecting to redis: {e}")
             
-    def set_value_for_an_existing_key(self, prefix, key, value):
-        """Set a key-value pair in the Redis database if it exists"""
-        if not self.connection:
-            self.connect()
-            
-        redis_key = f"{prefix}:{key}"
-        # The key exists , set its value
-        if self.connection.exists(redis_key):
-            self.connection.set(redis_key, value)      
+    @timed('redis_seconds')
     def set_value(self, key, value):
         """Set a key-value pair in the Redis database """
         if not self.connection:
             self.connect()
         self.connection.set(key, value)    
 
+    @timed('redis_seconds')
     def get_value(self, key):
         """Get the value associated with a given key from the Redis database."""
         if not self.connection:
             self.connect()
         return self.connection.get(key)
     
+    @timed('redis_seconds')
     def delete(self, key):
         """Delete the key-value pair in the Redis database."""
-        if self.exists(key):
-            self.connection.delete(key)
+        if not self.connection:
+            self.connect()
+        # DEL ignores missing keys, one round trip
+        self.connection.delete(key)
     
+    @timed('redis_seconds')
     def exists(self, key):
         """Check whether the key exists in the Redis database."""
         return self.connection.exists(key)
@@ -56,32 +61,226 @@ class RedisManager:
         if self.connection:
             self.connection.close()
 
-    def get_keys_with_value_and_prefix(self, key_prefix, target_value):
-        cursor = 0
-        matching_keys = []
+    @timed('redis_seconds')
+    def add_to_set(self, key, members, chunk_size=1000):
+        """Add the members to a Redis set, chunk_size members per SADD command."""
+        if not self.connection:
+            self.connect()
 
-        # Convert target_value to bytes using utf-8 encoding
-        target_value_bytes = target_value.encode('utf-8')
+        chunk = []
+        for member in members:
+            chunk.append(member)
+            if len(chunk) >= chunk_size:
+                self.connection.sadd(key, *chunk)
+                chunk = []
+        if chunk:
+            self.connection.sadd(key, *chunk)
 
-        while True:
-            cursor, keys = self.connection.scan(cursor, match=f"{key_prefix}:*", count=1000)
-            # Break out of the loop if no keys are found
-            if keys == []:
-                break
+    @timed('redis_seconds')
+    def remove_from_set(self, key, members, chunk_size=1000):
+        """Remove the members from a Redis set, chunk_size members per SREM command."""
+        if not self.connection:
+            self.connect()
 
-            # Retrieve values for multiple keys in a single Redis round-trip
-            values = self.connection.mget(keys)
-            
-            for key, value in zip(keys, values):            
-                # Decode key to get identifier
-                identifier = key.decode('utf-8').split(":")[-1]
-    
-                # Check if the values match after converting to bytes
-                if value == target_value_bytes:
-                    matching_keys.append(identifier)
+        members = list(members)
+        for start in range(0, len(members), chunk_size):
+            self.connection.srem(key, *members[start:start + chunk_size])
+
+    @timed('redis_seconds')
+    def add_to_set_and_lookup(self, add_key, members, check_keys=(), hash_key=None):
+        """Add the members to a set, check them against other sets and get their values from a hash
+        in a single Redis round-trip. Returns one list of membership flags per key in check_keys
+        and the list of hash values (None for the members missing from the hash)."""
+        if not self.connection:
+            self.connect()
+        if not members:
+            return [[] for _ in check_keys], []
+
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.sadd(add_key, *members)
+        for check_key in check_keys:
+            for member in members:
+                pipeline.sismember(check_key, member)
+        if hash_key:
+            pipeline.hmget(hash_key, members)
+        results = pipeline.execute()[1:]
+
+        flags = [[bool(result) for result in results[index * len(members):(index + 1) * len(members)]]
+                 for index in range(len(check_keys))]
+        hash_values = [value.decode('utf-8') if value is not None else None for value in results[-1]] if hash_key else []
+        return flags, hash_values
 
-            # Break out of the loop when cursor is 0
+    @timed('redis_seconds')
+    def set_hash_values(self, key, mapping, chunk_size=1000):
+        """Set the fields of a Redis hash, chunk_size fields per HSET command."""
+        if not self.connection:
+            self.connect()
+
+        chunk = {}
+        for field, value in mapping.items():
+            chunk[field] = value
+            if len(chunk) >= chunk_size:
+                self.connection.hset(key, mapping=chunk)
+                chunk = {}
+        if chunk:
+            self.connection.hset(key, mapping=chunk)
+
+    @timed('redis_seconds')
+    def get_hash_values(self, key, fields):
+        """Get the values of the fields of a Redis hash in one HMGET (None for the missing fields)."""
+        if not self.connection:
+            self.connect()
+        if not fields:
+            return []
+        return [value.decode('utf-8') if value is not None else None for value in self.connection.hmget(key, list(fields))]
+
+    @timed('redis_seconds')
+    def delete_hash_fields(self, key, fields, chunk_size=1000):
+        """Delete the fields from a Redis hash, chunk_size fields per HDEL command."""
+        if not self.connection:
+            self.connect()
+
+        fields = list(fields)
+        for start in range(0, len(fields), chunk_size):
+            self.connection.hdel(key, *fields[start:start + chunk_size])
+
+    @timed('redis_seconds')
+    def set_size(self, key):
+        """Get the number of members of the Redis set."""
+        if not self.connection:
+            self.connect()
+        return self.connection.scard(key)
+
+    @timed('redis_seconds')
+    def get_set_difference(self, key, *other_keys):
+        """Get the members of the set that are not in any of the other sets."""
+        if not self.connection:
+            self.connect()
+        return [member.decode('utf-8') for member in self.connection.sdiff(key, *other_keys)]
+
+    @timed('redis_seconds')
+    def rename(self, key, new_key):
+        """Rename a key, replacing new_key when it exists."""
+        if not self.connection:
+            self.connect()
+        self.connection.rename(key, new_key)
+
+    @timed('redis_seconds')
+    def sync_set_and_hash(self, set_key, hash_key, mapping):
+        """Add the fields of the mapping to a set and write the ones whose value differs from the
+        value in the hash, in two round-trips. Returns the number of hash fields written."""
+        if not self.connection:
+            self.connect()
+        if not mapping:
+            return 0
+
+        fields = list(mapping)
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.sadd(set_key, *fields)
+        pipeline.hmget(hash_key, fields)
+        stored_values = pipeline.execute()[1]
+
+        changed = {field: mapping[field] for field, stored_value in zip(fields, stored_values)
+                   if stored_value is None or stored_value.decode('utf-8') != mapping[field]}
+        if changed:
+            self.connection.hset(hash_key, mapping=changed)
+        return len(changed)
+
+    @timed('redis_seconds')
+    def delete_hash_fields_not_in_set(self, hash_key, set_key, chunk_size=1000):
+        """Delete the fields of a hash that are not members of the set, scanning chunk_size fields
+        at a time. Returns the number of deleted fields."""
+        if not self.connection:
+            self.connect()
+
+        deleted = 0
+        cursor = 0
+        while True:
+            cursor, fields = self.connection.hscan(hash_key, cursor, count=chunk_size)
+            fields = list(fields)
+            if fields:
+                pipeline = self.connection.pipeline(transaction=False)
+                for field in fields:
+                    pipeline.sismember(set_key, field)
+                stale_fields = [field for field, is_member in zip(fields, pipeline.execute()) if not is_member]
+                if stale_fields:
+                    self.connection.hdel(hash_key, *stale_fields)
+                    deleted += len(stale_fields)
             if cursor == 0:
-                break
-        return matching_keys
+                return deleted
+
+    @timed('redis_seconds')
+    def increment(self, key, amount=1):
+        """Add amount to the integer value of a key and return the new value."""
+        if not self.connection:
+            self.connect()
+        return self.connection.incrby(key, amount)
+
+    @timed('redis_seconds')
+    def expire_at(self, key, timestamp):
+        """Delete the key at the given unix time."""
+        if not self.connection:
+            self.connect()
+        self.connection.expireat(key, int(timestamp))
+
+    @timed('redis_seconds')
+    def remove_hash_field(self, key, field):
+        """Delete a field from a Redis hash. Returns whether it was there, only one caller gets True."""
+        if not self.connection:
+            self.connect()
+        return bool(self.connection.hdel(key, field))
+
+    @timed('redis_seconds')
+    def get_set_members(self, key):
+        """Get all the members of the Redis set."""
+        if not self.connection:
+            self.connect()
+        return [member.decode('utf-8') for member in self.connection.smembers(key)]
+
+    @timed('redis_seconds')
+    def get_hash(self, key):
+        """Get all the fields and values of a Redis hash."""
+        if not self.connection:
+            self.connect()
+        return {field.decode('utf-8'): value.decode('utf-8') for field, value in self.connection.hgetall(key).items()}
 
+    @timed('redis_seconds')
+    def set_hash_field_if_not_exists(self, key, field, value):
+        """Set the field of a Redis hash only when it is not set yet. Returns whether it was set."""
+        if not self.connection:
+            self.connect()
+        return bool(self.connection.hsetnx(key, field, value))
+
+    @timed('redis_seconds')
+    def push_to_list(self, key, values):
+        """Append the values to the end of a Redis list."""
+        if not self.connection:
+            self.connect()
+        if values:
+            self.connection.rpush(key, *values)
+
+    @timed('redis_seconds')
+    def pop_from_list(self, key):
+        """Remove and return the first value of a Redis list, None when it is empty."""
+        if not self.connection:
+            self.connect()
+        value = self.connection.lpop(key)
+        return value.decode('utf-8') if value is not None else None
+
+    @timed('redis_seconds')
+    def add_to_stream(self, key, entries, maxlen=None):
+        """Append entries (dicts of fields) to a Redis Stream in one round trip, trimmed to about maxlen entries."""
+        if not self.connection:
+            self.connect()
+        pipe = self.connection.pipeline(transaction=False)
+        for entry in entries:
+            pipe.xadd(key, entry, maxlen=maxlen, approximate=True)
+        return pipe.execute()
+
+    @timed('redis_seconds')
+    def read_stream(self, key, after='0', count=1000):
+        """Entries of a Redis Stream after the given id, as (id, fields) pairs."""
+        if not self.connection:
+            self.connect()
+        streams = self.connection.xread({key: after}, count=count)
+        return streams[0][1] if streams else []
@@ -0,0 +1,93 @@
+import redis
+from psycopg2.pool import ThreadedConnectionPool
+from pymongo import MongoClient
+from scrapy import signals
+from scrapy.utils.project import get_project_settings
+from database_managers.postgresql_manager import PostgreSQLManager
+from database_managers.mongodb_manager import MongoDBManager
+from database_managers.redis_manager import RedisManager
+
+class DatabaseResources:
+    """Connection pools shared by the spider, the pipelines and the exporter of a crawl:
+    a psycopg2 pool, one MongoClient and one Redis ConnectionPool. Each of them is created
+    on first use, and the managers handed out borrow their connections from them."""
+
+    def __init__(self, settings=None):
+        self.settings = settings or get_project_settings()
+        self._postgres_pool = None
+        self._mongo_client = None
+        self._redis_pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # One registry per crawler, whoever asks first creates it. A registry attached to the
+        # crawler beforehand (by the scheduler, to keep the pools across crawls) is used as is
+        resources = getattr(crawler, 'database_resources', None)
+        if resources is None:
+            resources = cls(crawler.settings)
+            crawler.database_resources = resources
+            # engine_stopped comes after spider_closed, once the pipelines are done with their connections
+            crawler.signals.connect(resources.close, signal=signals.engine_stopped)
+        return resources
+
+    @property
+    def postgres_pool(self):
+        if self._postgres_pool is None:
+            # Only up to minconn idle connections are kept open, the others are closed when given back
+            self._postgres_pool = ThreadedConnectionPool(
+                self.settings.getint('POSTGRES_POOL_MIN_SIZE', 2),
+                self.settings.getint('POSTGRES_POOL_MAX_SIZE', 5),
+                host=self.settings.get('POSTGRES_HOST'),
+                port=self.settings.get('POSTGRES_PORT'),
+                database=self.settings.get('POSTGRES_DB'),
+                user=self.settings.get('POSTGRES_USER'),
+                password=self.settings.get('POSTGRES_PASSWORD'),
+            )
+        return self._postgres_pool
+
+    @property
+    def mongo_client(self):
+        if self._mongo_client is None:
+            mongo_uri = f"mongodb://{self.settings.get('MONGO_USERNAME')}:{self.settings.get('MONGO_PASSWORD')}@{self.settings.get('MONGO_HOST')}:{self.settings.get('MONGO_PORT')}"
+            self._mongo_client = MongoClient(mongo_uri, maxPoolSize=self.settings.getint('MONGO_MAX_POOL_SIZE', 10))
+        return self._mongo_client
+
+    @property
+    def redis_pool(self):
+        if self._redis_pool is None:
+            self._redis_pool = redis.ConnectionPool(
+                host=self.settings.get('REDIS_HOST'),
+                port=self.settings.get('REDIS_PORT'),
+                db=self.settings.get('REDIS_DB'),
+                max_connections=self.settings.getint('REDIS_MAX_CONNECTIONS', 10),
+            )
+        return self._redis_pool
+
+    def postgresql_manager(self, settings=None, metrics=None):
+        # The pools are shared by every crawl of the process, the table comes from the settings of
+        # the crawl asking for the manager (each site of a multi-site run has its own), and the
+        # calls are timed in the metrics of that crawl
+        try:
+            pool = self.postgres_pool
+        except Exception as e:
+            # The manager reports the error and retries to connect when it is used
+            print(f"Error creating the PostgreSQL connection pool: {e}")
+            pool = None
+        return PostgreSQLManager(settings or self.settings, pool=pool, metrics=metrics)
+
+    def mongodb_manager(self, settings=None, metrics=None):
+        return MongoDBManager(settings or self.settings, client=self.mongo_client, metrics=metrics)
+
+    def redis_manager(self, metrics=None):
+        return RedisManager(self.settings, connection_pool=self.redis_pool, metrics=metrics)
+
+    def close(self):
+        if self._postgres_pool is not None:
+            self._postgres_pool.closeall()
+            self._postgres_pool = None
+        if self._mongo_client is not None:
+            self._mongo_client.close()
+            self._mongo_client = None
+        if self._redis_pool is not None:
+            self._redis_pool.disconnect()
+            self._redis_pool = None
@@ -0,0 +1,173 @@
+"""Change feeds of JobSpider.
+
+The spider publishes an event for every job it finds new or changed on the website and for every
+closed job the sweep deletes, in the order it finds them:
+
+    {"type": "added", "job_identifier": "...", "content_hash": "...", "site": "fedex", "time": "2024-05-01T10:00:00+00:00"}
+
+"updated" events carry the new content_hash, "removed" events none. The events are published
+as soon as the spider knows about the change, the stores may get the job a moment later.
+
+FileChangeFeed appends the events as JSON lines to a local file, consumers keep the byte offset
+they have read up to and read on from it with read_changes. Once the file holds max_bytes it is
+renamed after the offset it starts at (job_changes.<offset>.ndjson) and a new one is started, so
+the offsets of the consumers stay valid. Only the newest max_files rotated files are kept.
+RedisStreamChangeFeed adds them to a Redis Stream, consumers read it with XREAD (or read) from
+the last id they have seen. The feed is chosen with the CHANGE_FEED_BACKEND setting. In a
+multi-site run every site (SITE_NAME) has its own file or stream. Distributed workers
+(CRAWL_DISTRIBUTED) each have their own local file, so they need the stream.
+"""
+import json
+import os
+from datetime import datetime, timezone
+
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+
+def change_event(event_type, identifier, fingerprint=None, site=None):
+    event = {'type': event_type, 'job_identifier': identifier}
+    if fingerprint:
+        event['content_hash'] = fingerprint
+    if site:
+        event['site'] = site
+    event['time'] = datetime.now(timezone.utc).isoformat()
+    return event
+
+
+def rotated_path(path, start):
+    root, extension = os.path.splitext(path)
+    return f"{root}.{start:020d}{extension}"
+
+
+def feed_files(path):
+    # (offset the file starts at, path) of the rotated files of a FileChangeFeed, oldest first,
+    # followed by the file being written
+    root, extension = os.path.splitext(path)
+    directory = os.path.dirname(path) or '.'
+    prefix = f"{os.path.basename(root)}."
+    files = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        start = name[len(prefix):len(name) - len(extension)]
+        if name.startswith(prefix) and name.endswith(extension) and start.isdigit():
+            files.append((int(start), os.path.join(directory, name)))
+    files.sort()
+    start = files[-1][0] + os.path.getsize(files[-1][1]) if files else 0
+    return files + [(start, path)]
+
+
+def read_changes(path, offset=0, max_events=1000):
+    # Returns (events, offset after them) of a FileChangeFeed from the byte offset on. The offset
+    # counts from the start of the feed, across the rotated files. An offset older than the oldest
+    # file kept goes on from that file, the events in between are gone
+    while True:
+        files = feed_files(path)
+        events = []
+        position = max(offset, files[0][0])
+        for start, file_path in files:
+            if len(events) >= max_events:
+                break
+            try:
+                with open(file_path, 'rb') as feed_file:
+                    feed_file.seek(0, os.SEEK_END)
+                    if position >= start + feed_file.tell():
+                        continue
+                    feed_file.seek(position - start)
+                    for line in feed_file:
+                        # A line still being written is read next time
+                        if not line.endswith(b'\n'):
+                            break
+                        events.append(json.loads(line))
+                        position += len(line)
+                        if len(events) >= max_events:
+                            break
+            except FileNotFoundError:
+                pass
+        # Read again when the feed was rotated meanwhile, the offsets of the files changed
+        if feed_files(path) == files:
+            return events, position
+
+
+class FileChangeFeed:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_files=5):
+        self.path = path
+        # The file is rotated once it holds max_bytes (0 never rotates it), max_files rotated files are kept
+        self.max_bytes = max_bytes
+        self.max_files = max(max_files, 1)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.feed_file = open(self.path, 'ab')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('CHANGE_FEED_PATH', 'job_changes.ndjson')
+        # Every site of a multi-site run has its own file
+        site_name = settings.get('SITE_NAME')
+        if site_name:
+            root, extension = os.path.splitext(path)
+            path = f"{root}_{site_name}{extension}"
+        return cls(
+            path,
+            max_bytes=settings.getint('CHANGE_FEED_MAX_BYTES', 64 * 1024 * 1024),
+            max_files=settings.getint('CHANGE_FEED_MAX_FILES', 5),
+        )
+
+    def publish(self, events):
+        # One write and one fsync per batch
+        if not events:
+            return
+        self.feed_file.write(b''.join(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n' for event in events))
+        self.feed_file.flush()
+        os.fsync(self.feed_file.fileno())
+        if self.max_bytes and self.feed_file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        # The file is renamed after the offset it starts at, so the offsets of the consumers stay valid
+        start, _ = feed_files(self.path)[-1]
+        self.feed_file.close()
+        os.replace(self.path, rotated_path(self.path, start))
+        self.feed_file = open(self.path, 'ab')
+        for _, old_path in feed_files(self.path)[:-1][:-self.max_files]:
+            os.remove(old_path)
+
+    def close(self):
+        self.feed_file.close()
+
+
+class RedisStreamChangeFeed:
+    def __init__(self, redis_manager, stream_key='job_changes', maxlen=None):
+        self.redis = redis_manager
+        self.stream_key = stream_key
+        # The stream is trimmed to about maxlen events, the oldest ones go first
+        self.maxlen = maxlen
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from database_managers.resources import DatabaseResources
+        from jobs_project.metrics import Metrics
+
+        # Borrows its connections from the Redis pool of the crawl
+        site_name = crawler.settings.get('SITE_NAME')
+        return cls(
+            DatabaseResources.from_crawler(crawler).redis_manager(metrics=Metrics.from_crawler(crawler)),
+            stream_key=f"{site_name}:job_changes" if site_name else 'job_changes',
+            maxlen=crawler.settings.getint('CHANGE_FEED_MAXLEN', 0) or None,
+        )
+
+    def publish(self, events):
+        # One round trip per batch
+        if events:
+            self.redis.add_to_stream(self.stream_key, events, maxlen=self.maxlen)
+
+    def read(self, after='0', max_events=1000):
+        # Returns (events, id of the last one) from the id after on
+        entries = self.redis.read_stream(self.stream_key, after, max_events)
+        events = [{field.decode('utf-8'): value.decode('utf-8') for field, value in fields.items()} for _, fields in entries]
+        return events, (entries[-1][0].decode('utf-8') if entries else after)
+
+    def close(self):
+        pass
@@ -0,0 +1,210 @@
+"""Coordination of several JobSpider workers crawling the same website through Redis.
+
+The worker that joins a round first becomes its planner. It loads the job identifiers, fetches the
+featured jobs and the first page, then splits the remaining pages into shards of CRAWL_SHARD_PAGES
+pages on a Redis list. Every worker, the planner included, takes shards from the list until it is
+empty. The first worker to see every shard done runs the sweep of the closed jobs, once per round,
+and the last worker to leave saves the table generation and clears the round.
+
+Every worker writes a heartbeat while it is in the round, and holds a lease on the shard it crawls.
+The shard of a worker whose heartbeat is older than lease_timeout seconds goes back on the list for
+another worker. A round whose planner died before sharing the pages, or whose workers all died, is
+abandoned and the next worker to join starts a new one. The keys of a round expire timeout seconds
+after the planner created it, joining or heartbeating never extends them.
+"""
+import os
+import socket
+import time
+
+ROUND_PLANNING = 'planning'
+ROUND_RUNNING = 'running'
+
+
+def default_worker_id():
+    # Unique per process, used when CRAWL_WORKER_ID is not set
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class CrawlCoordinator:
+    def __init__(self, redis_manager, worker_id=None, key_prefix='crawl', shard_pages=10, timeout=3600, lease_timeout=60):
+        self.redis = redis_manager
+        self.worker_id = worker_id or default_worker_id()
+        self.shard_pages = max(shard_pages, 1)
+        # Keys of a round expire after timeout seconds, so a round whose workers died does not block the next ones
+        self.timeout = timeout
+        # A worker that has not written its heartbeat for lease_timeout seconds is taken for dead
+        self.lease_timeout = lease_timeout
+        # Redis hash of the round: planner, state, deadline, number of shards, pagination of the API and sweeper
+        self.round_key = f"{key_prefix}:round"
+        # Redis list of the shards left, 'first_page-last_page'
+        self.shards_key = f"{key_prefix}:shards"
+        # Redis hash of the shards being crawled, shard -> worker
+        self.leases_key = f"{key_prefix}:leases"
+        # Redis set of the shards done. A shard reclaimed from a slow worker may be reported done twice,
+        # it is counted once
+        self.done_key = f"{key_prefix}:done"
+        # Redis set of the pages that failed in any worker
+        self.failed_pages_key = f"{key_prefix}:failed_pages"
+        # Redis hash of the workers in the round, worker -> time of its last heartbeat
+        self.workers_key = f"{key_prefix}:workers"
+        # Set when a worker could not write all of its items or deletions
+        self.dirty_key = f"{key_prefix}:dirty"
+        # Unix time the keys of the round expire at, set by the planner
+        self.deadline = None
+        # Shard this worker is crawling
+        self.shard = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from database_managers.resources import DatabaseResources
+        from jobs_project.metrics import Metrics
+
+        settings = crawler.settings
+        # Every site of a multi-site run has its own rounds
+        site_name = settings.get('SITE_NAME')
+        return cls(
+            DatabaseResources.from_crawler(crawler).redis_manager(metrics=Metrics.from_crawler(crawler)),
+            worker_id=settings.get('CRAWL_WORKER_ID'),
+            key_prefix=f"{site_name}:crawl" if site_name else 'crawl',
+            shard_pages=settings.getint('CRAWL_SHARD_PAGES', 10),
+            timeout=settings.getint('CRAWL_ROUND_TIMEOUT', 3600),
+            lease_timeout=settings.getint('CRAWL_LEASE_TIMEOUT', 60),
+        )
+
+    def round_keys(self):
+        return (self.round_key, self.shards_key, self.leases_key, self.done_key, self.failed_pages_key, self.workers_key, self.dirty_key)
+
+    def expire_with_round(self, key):
+        # Keys written after the planner created the round expire with it
+        if not self.deadline:
+            self.deadline = int(self.round_info().get('deadline', 0)) or None
+        if self.deadline:
+            self.redis.expire_at(key, self.deadline)
+
+    def join(self):
+        # Returns whether this worker is the planner of the round
+        if self.is_abandoned():
+            self.finish_round()
+        self.heartbeat()
+        is_planner = self.redis.set_hash_field_if_not_exists(self.round_key, 'planner', self.worker_id)
+        if is_planner:
+            self.deadline = int(time.time() + self.timeout)
+            self.redis.set_hash_values(self.round_key, {'state': ROUND_PLANNING, 'deadline': self.deadline})
+            for key in (self.round_key, self.workers_key):
+                self.redis.expire_at(key, self.deadline)
+        else:
+            self.expire_with_round(self.workers_key)
+        return is_planner
+
+    def heartbeat(self):
+        self.redis.set_hash_values(self.workers_key, {self.worker_id: time.time()})
+        self.expire_with_round(self.workers_key)
+
+    def live_workers(self):
+        now = time.time()
+        return {worker for worker, heartbeat in self.redis.get_hash(self.workers_key).items()
+                if now - float(heartbeat) <= self.lease_timeout}
+
+    def is_abandoned(self):
+        # A round nobody works on anymore, or whose planner died before sharing the pages
+        round_info = self.round_info()
+        if not round_info:
+            return False
+        live_workers = self.live_workers()
+        if not live_workers:
+            return True
+        return round_info.get('state') != ROUND_RUNNING and round_info.get('planner') not in live_workers
+
+    def plan(self, first_page, last_page, page_size, total_count):
+        # Pages first_page..last_page go to the shards, the planner's own pages count as one more shard
+        shards = [f"{start}-{min(start + self.shard_pages - 1, last_page)}"
+                  for start in range(first_page, last_page + 1, self.shard_pages)]
+        self.redis.push_to_list(self.shards_key, shards)
+        self.expire_with_round(self.shards_key)
+        # The state is set last, the workers waiting for the plan find the shards on the list
+        self.redis.set_hash_values(self.round_key, {
+            'shards': len(shards) + 1,
+            'last_page': last_page,
+            'page_size': page_size or 0,
+            'total_count': total_count or 0,
+            'state': ROUND_RUNNING,
+        })
+        return len(shards)
+
+    def round_info(self):
+        return self.redis.get_hash(self.round_key)
+
+    def is_planning(self):
+        # A round with a planner but no plan yet, or a state not written yet right after the election
+        round_info = self.round_info()
+        return bool(round_info) and round_info.get('state') != ROUND_RUNNING
+
+    def next_shard(self):
+        # Returns (first_page, last_page, round_info) of the next shard, None when there is none left.
+        # The shard is leased to this worker until it reports it done
+        shard = self.redis.pop_from_list(self.shards_key)
+        if shard is None:
+            return None
+        self.shard = shard
+        self.redis.set_hash_values(self.leases_key, {shard: self.worker_id})
+        self.expire_with_round(self.leases_key)
+        first_page, last_page = (int(page) for page in shard.split('-'))
+        return first_page, last_page, self.round_info()
+
+    def reclaim_shards(self):
+        # Puts the shards of the workers that stopped heartbeating back on the list. Returns the
+        # number of shards still leased to live workers
+        live_workers = self.live_workers()
+        leased = 0
+        for shard, worker in self.redis.get_hash(self.leases_key).items():
+            if worker in live_workers:
+                leased += 1
+            elif self.redis.remove_hash_field(self.leases_key, shard):
+                # Only the worker that removed the lease puts the shard back
+                self.redis.push_to_list(self.shards_key, [shard])
+        return leased
+
+    def is_waiting(self):
+        # Whether an idle worker should stay in the round: the pages are not shared yet,
+        # or some shards may still come back from a worker that dies
+        if self.is_planning():
+            return not self.is_abandoned()
+        return self.reclaim_shards() > 0
+
+    def shard_done(self, failed_pages):
+        # Returns whether this worker runs the sweep: every shard of the round is done and no other
+        # worker has claimed the sweep yet. The planner's own pages count as the shard 'first'
+        shard = self.shard or 'first'
+        if self.shard is not None:
+            self.redis.remove_hash_field(self.leases_key, self.shard)
+            self.shard = None
+        if failed_pages:
+            self.redis.add_to_set(self.failed_pages_key, [str(page) for page in failed_pages])
+            self.expire_with_round(self.failed_pages_key)
+        self.redis.add_to_set(self.done_key, [shard])
+        self.expire_with_round(self.done_key)
+        return self.is_complete() and self.redis.set_hash_field_if_not_exists(self.round_key, 'sweeper', self.worker_id)
+
+    def is_complete(self):
+        shards = int(self.round_info().get('shards', 0))
+        return bool(shards) and self.redis.set_size(self.done_key) >= shards
+
+    def failed_pages(self):
+        return {int(page) for page in self.redis.get_set_members(self.failed_pages_key)}
+
+    def mark_dirty(self):
+        self.redis.set_value(self.dirty_key, self.worker_id)
+        self.expire_with_round(self.dirty_key)
+
+    def is_dirty(self):
+        return bool(self.redis.get_value(self.dirty_key))
+
+    def leave(self):
+        # Returns whether this was the last live worker of the round
+        self.redis.remove_hash_field(self.workers_key, self.worker_id)
+        return not self.live_workers()
+
+    def finish_round(self):
+        # The next worker to join starts a new round
+        for key in self.round_keys():
+            self.redis.delete(key)
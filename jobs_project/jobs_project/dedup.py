@@ -0,0 +1,302 @@
+"""Dedup backends of JobSpider.
+
+A backend keeps the identifiers and content fingerprints of the stored jobs, the generation of
+the PostgreSQL table they mirror and the page cache between crawls, plus the identifiers seen on
+the website during a crawl. Whether a job is stored is answered by its fingerprint alone, so a
+job the sweep forgot is stored again when it is reposted.
+
+RedisDedupBackend keeps them in Redis, where several workers can share them.
+SQLiteDedupBackend keeps them in a local file and answers the lookups in-process, with a
+Bloom filter in front of the table so most new jobs are ruled out without a query.
+The backend is chosen with the DEDUP_BACKEND setting. In a multi-site run every site (SITE_NAME)
+has its own keys or its own file.
+"""
+import hashlib
+import math
+import os
+import sqlite3
+from jobs_project.metrics import Metrics, timed
+
+
+class RedisDedupBackend:
+    def __init__(self, redis_manager, key_prefix='job_identifiers', cache_key='job_cache', page_cache_key='page_cache'):
+        self.redis = redis_manager
+        # Redis set of the identifiers stored in the database
+        self.known_key = f"{key_prefix}:known"
+        # Redis set of the identifiers seen on the website during this crawl
+        self.seen_key = f"{key_prefix}:seen"
+        # Redis hash of the content fingerprints of the stored jobs
+        self.fingerprints_key = f"{key_prefix}:fingerprints"
+        # Generation of the PostgreSQL table that the known set and the fingerprints mirror
+        self.generation_key = f"{key_prefix}:generation"
+        # New known set built while reconciling, swapped in at the end
+        self.reload_key = f"{key_prefix}:reload"
+        # Redis set of the job cache of older versions, deleted at the start of every crawl
+        self.cache_key = cache_key
+        # Redis hash of the cached pages, url -> JSON entry
+        self.page_cache_key = page_cache_key
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from database_managers.resources import DatabaseResources
+
+        # Borrows its connections from the Redis pool of the crawl
+        redis_manager = DatabaseResources.from_crawler(crawler).redis_manager(metrics=Metrics.from_crawler(crawler))
+        site_name = crawler.settings.get('SITE_NAME')
+        if not site_name:
+            return cls(redis_manager)
+        return cls(redis_manager, key_prefix=f"{site_name}:job_identifiers",
+                   cache_key=f"{site_name}:job_cache", page_cache_key=f"{site_name}:page_cache")
+
+    def start_crawl(self):
+        # Nothing has been seen yet in this crawl
+        self.redis.delete(self.seen_key)
+        self.redis.delete(self.cache_key)
+
+    def get_generation(self):
+        generation = self.redis.get_value(self.generation_key)
+        return generation.decode('utf-8') if generation else None
+
+    def set_generation(self, generation):
+        self.redis.set_value(self.generation_key, generation)
+
+    def clear_generation(self):
+        self.redis.delete(self.generation_key)
+
+    def clear(self):
+        # Forget the stored jobs and the pages of any previous database
+        self.redis.delete(self.known_key)
+        self.redis.delete(self.fingerprints_key)
+        self.redis.delete(self.page_cache_key)
+
+    def mark_seen(self, identifiers):
+        # Returns the stored fingerprints of the identifiers (None for the jobs that are not stored)
+        _, stored_fingerprints = self.redis.add_to_set_and_lookup(self.seen_key, identifiers, [], self.fingerprints_key)
+        return stored_fingerprints
+
+    def add_stored(self, new_identifiers, fingerprints):
+        # Stored jobs are known from now on, the next crawl can skip the reload from PostgreSQL
+        self.redis.add_to_set(self.known_key, new_identifiers)
+        self.redis.set_hash_values(self.fingerprints_key, fingerprints)
+
+    def get_cached_pages(self, urls):
+        values = self.redis.get_hash_values(self.page_cache_key, urls)
+        return {url: value for url, value in zip(urls, values) if value is not None}
+
+    def cache_page(self, url, value):
+        self.redis.set_hash_values(self.page_cache_key, {url: value})
+
+    def reconcile(self, chunks):
+        # The chunks of identifier -> fingerprint read from PostgreSQL go into a new known set, and
+        # only the fingerprints that differ from the ones in Redis are written.
+        # Returns the number of identifiers, of fingerprints written and of fingerprints removed
+        self.redis.delete(self.reload_key)
+        identifiers_count = 0
+        written_count = 0
+        for fingerprints in chunks:
+            written_count += self.redis.sync_set_and_hash(self.reload_key, self.fingerprints_key, fingerprints)
+            identifiers_count += len(fingerprints)
+
+        # The cached pages were checked against the old state, every page is parsed again once
+        self.redis.delete(self.page_cache_key)
+
+        # Swap in the new known set and drop the fingerprints of the jobs that are not stored anymore
+        if identifiers_count:
+            self.redis.rename(self.reload_key, self.known_key)
+        else:
+            self.redis.delete(self.known_key)
+        deleted_count = self.redis.delete_hash_fields_not_in_set(self.fingerprints_key, self.known_key)
+        return identifiers_count, written_count, deleted_count
+
+    def seen_count(self):
+        return self.redis.set_size(self.seen_key)
+
+    def known_count(self):
+        return self.redis.set_size(self.known_key)
+
+    def inactive_identifiers(self):
+        # The known identifiers that were not seen during this crawl, a single SDIFF
+        return self.redis.get_set_difference(self.known_key, self.seen_key)
+
+    def forget(self, identifiers):
+        self.redis.remove_from_set(self.known_key, identifiers)
+        self.redis.delete_hash_fields(self.fingerprints_key, identifiers)
+
+    def close(self):
+        # The connections belong to the pool of the crawl
+        pass
+
+
+class BloomFilter:
+    """Set of strings in a fixed bit array. No false negatives, and about error_rate false
+    positives once capacity members were added. Members can not be removed."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(capacity, 1000)
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, member):
+        # Double hashing, the hash_count positions come from the two halves of one digest
+        digest = hashlib.blake2b(member.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.size for index in range(self.hash_count)]
+
+    def add(self, member):
+        for position in self.positions(member):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, member):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(member))
+
+
+class SQLiteDedupBackend:
+    """Single node backend: the stored jobs, the cache, the pages and the generation live in a
+    SQLite file that persists between runs, and the seen identifiers of a crawl in memory."""
+
+    # Members per IN (...) query, below the SQLite limit on query parameters
+    query_chunk_size = 500
+
+    def __init__(self, path, error_rate=0.001, metrics=None):
+        self.path = path
+        self.error_rate = error_rate
+        self.metrics = metrics or Metrics()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (identifier TEXT PRIMARY KEY, fingerprint TEXT NOT NULL) WITHOUT ROWID;
+            DROP TABLE IF EXISTS cached;
+            CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+        """)
+        self.connection.commit()
+        self.seen = set()
+        self.build_filter()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('DEDUP_SQLITE_PATH', 'job_identifiers.sqlite3')
+        if settings.get('SITE_NAME'):
+            root, extension = os.path.splitext(path)
+            path = f"{root}_{settings.get('SITE_NAME')}{extension}"
+        return cls(path, settings.getfloat('DEDUP_BLOOM_ERROR_RATE', 0.001), metrics=Metrics.from_crawler(crawler))
+
+    @timed('sqlite_seconds')
+    def build_filter(self):
+        # Sized for twice the stored jobs, it is built again once it holds more than its capacity
+        (count,), = self.connection.execute("SELECT COUNT(*) FROM jobs")
+        self.filter = BloomFilter(count * 2, self.error_rate)
+        for (identifier,) in self.connection.execute("SELECT identifier FROM jobs"):
+            self.filter.add(identifier)
+
+    def add_to_filter(self, identifiers):
+        for identifier in identifiers:
+            self.filter.add(identifier)
+        if self.filter.count > self.filter.capacity:
+            self.build_filter()
+
+    def select_in(self, query, members):
+        # Runs a query with an IN (...) placeholder for the members, query_chunk_size at a time
+        for start in range(0, len(members), self.query_chunk_size):
+            chunk = members[start:start + self.query_chunk_size]
+            yield from self.connection.execute(query.format(', '.join('?' * len(chunk))), chunk)
+
+    def start_crawl(self):
+        self.seen = set()
+
+    def get_generation(self):
+        row = self.connection.execute("SELECT value FROM state WHERE key = 'generation'").fetchone()
+        return row[0] if row else None
+
+    def set_generation(self, generation):
+        self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('generation', ?)", (generation,))
+        self.connection.commit()
+
+    def clear_generation(self):
+        # Committed right away, so a crawl that dies halfway leaves no generation behind
+        self.connection.execute("DELETE FROM state WHERE key = 'generation'")
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute("DELETE FROM jobs")
+        self.connection.execute("DELETE FROM pages")
+        self.connection.commit()
+        self.build_filter()
+
+    @timed('sqlite_seconds')
+    def stored_fingerprints(self, identifiers):
+        # Only the identifiers that may be in the filter are looked up in the table
+        candidates = [identifier for identifier in set(identifiers) if identifier in self.filter]
+        found = dict(self.select_in("SELECT identifier, fingerprint FROM jobs WHERE identifier IN ({})", candidates))
+        return [found.get(identifier) for identifier in identifiers]
+
+    def mark_seen(self, identifiers):
+        self.seen.update(identifiers)
+        return self.stored_fingerprints(identifiers)
+
+    @timed('sqlite_seconds')
+    def add_stored(self, new_identifiers, fingerprints):
+        # The new identifiers are among the fingerprints, one table holds both
+        self.connection.executemany("INSERT OR REPLACE INTO jobs (identifier, fingerprint) VALUES (?, ?)", fingerprints.items())
+        # Committed with every page, a crash loses nothing the spider has already yielded
+        self.connection.commit()
+        self.add_to_filter(new_identifiers)
+
+    def get_cached_pages(self, urls):
+        return dict(self.select_in("SELECT url, value FROM pages WHERE url IN ({})", list(urls)))
+
+    @timed('sqlite_seconds')
+    def cache_page(self, url, value):
+        self.connection.execute("INSERT OR REPLACE INTO pages (url, value) VALUES (?, ?)", (url, value))
+        self.connection.commit()
+
+    @timed('sqlite_seconds')
+    def reconcile(self, chunks):
+        # The rows of PostgreSQL are collected in a temporary table, then the jobs table is
+        # brought in line with it: changed and missing rows written, rows not in PostgreSQL deleted
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS reload (identifier TEXT PRIMARY KEY, fingerprint TEXT NOT NULL) WITHOUT ROWID")
+        self.connection.execute("DELETE FROM reload")
+        identifiers_count = 0
+        for fingerprints in chunks:
+            self.connection.executemany("INSERT OR REPLACE INTO reload (identifier, fingerprint) VALUES (?, ?)", fingerprints.items())
+            identifiers_count += len(fingerprints)
+
+        written_count = self.connection.execute("""
+            INSERT OR REPLACE INTO jobs (identifier, fingerprint)
+            SELECT reload.identifier, reload.fingerprint FROM reload LEFT JOIN jobs USING (identifier)
+            WHERE jobs.fingerprint IS NOT reload.fingerprint
+        """).rowcount
+        deleted_count = self.connection.execute(
+            "DELETE FROM jobs WHERE identifier NOT IN (SELECT identifier FROM reload)"
+        ).rowcount
+        self.connection.execute("DELETE FROM reload")
+        # The cached pages were checked against the old state, every page is parsed again once
+        self.connection.execute("DELETE FROM pages")
+        self.connection.commit()
+        self.build_filter()
+        return identifiers_count, written_count, deleted_count
+
+    def seen_count(self):
+        return len(self.seen)
+
+    def known_count(self):
+        (count,), = self.connection.execute("SELECT COUNT(*) FROM jobs")
+        return count
+
+    def inactive_identifiers(self):
+        return [identifier for identifier, in self.connection.execute("SELECT identifier FROM jobs") if identifier not in self.seen]
+
+    def forget(self, identifiers):
+        # The filter keeps them, a later lookup of one of them only costs a query
+        self.connection.executemany("DELETE FROM jobs WHERE identifier = ?", ((identifier,) for identifier in identifiers))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+from scrapy import signals
+from jobs_project.metrics import Metrics
+
+
+def site_path(path, site_name):
+    # crawl_metrics.json becomes crawl_metrics_<site>.json
+    if not path or not site_name:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}_{site_name}{extension}"
+
+
+class CrawlMetricsExtension:
+    """Publishes the crawl metrics to the Scrapy stats and dumps them to files when the spider closes."""
+
+    def __init__(self, stats, metrics, json_file, prometheus_file):
+        self.stats = stats
+        # The metrics of this crawler only, the other sites of a multi-site run have their own
+        self.metrics = metrics
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.start_time = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # Every site of a multi-site run writes its own files
+        site_name = crawler.settings.get('SITE_NAME')
+        extension = cls(
+            crawler.stats,
+            Metrics.from_crawler(crawler),
+            site_path(crawler.settings.get('METRICS_JSON_FILE'), site_name),
+            site_path(crawler.settings.get('METRICS_PROMETHEUS_FILE'), site_name),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self.start_time = time.monotonic()
+
+    def spider_closed(self, spider, reason):
+        elapsed_time = time.monotonic() - self.start_time
+        items = self.stats.get_value('item_scraped_count', 0)
+        pages = self.stats.get_value('response_received_count', 0)
+        self.metrics.increment('crawl_seconds', elapsed_time)
+        self.metrics.increment('items_scraped', items)
+        self.metrics.increment('pages_fetched', pages)
+
+        # Summaries of every histogram in the Scrapy stats, next to the per second rates
+        self.stats.set_value('metrics/items_per_second', items / elapsed_time if elapsed_time else 0)
+        self.stats.set_value('metrics/pages_per_second', pages / elapsed_time if elapsed_time else 0)
+        summary = self.metrics.to_dict()
+        for histogram in summary['histograms']:
+            name = '/'.join(['metrics', histogram['name']] + [str(value) for value in histogram['labels'].values()])
+            self.stats.set_value(f"{name}/count", histogram['count'])
+            self.stats.set_value(f"{name}/mean", histogram['mean'])
+            self.stats.set_value(f"{name}/max", histogram['max'])
+        for counter in summary['counters']:
+            name = '/'.join(['metrics', counter['name']] + [str(value) for value in counter['labels'].values()])
+            self.stats.set_value(name, counter['value'])
+
+        if self.json_file:
+            with open(self.json_file, 'w') as json_file:
+                json.dump(summary, json_file, indent=2)
+        if self.prometheus_file:
+            with open(self.prometheus_file, 'w') as prometheus_file:
+                prometheus_file.write(self.metrics.to_prometheus())
@@ -1,7 +1,10 @@
 import scrapy
+from itemadapter import ItemAdapter
+from itemadapter.adapter import AdapterInterface
 
 class JobItem(scrapy.Item):
     job_identifier = scrapy.Field()
+    content_hash = scrapy.Field()
     slug = scrapy.Field()
     language = scrapy.Field()
     languages = scrapy.Field()
@@ -52,3 +55,83 @@ class JobItem(scrapy.Item):
     full_location = scrapy.Field()
     short_location = scrapy.Field()
 
+
+
+# Fields of a job in a fixed order, the column order of the rows written to PostgreSQL
+JOB_FIELDS = tuple(JobItem.fields)
+
+
+class JobRecord:
+    """Job as yielded by the spider and written by the pipeline.
+
+    A slot per JobItem field instead of a dict per item. Fields missing from the API response are
+    left unset: they are written as NULL to PostgreSQL and left out of the MongoDB document."""
+
+    __slots__ = JOB_FIELDS
+    fields = JobItem.fields
+
+    def __init__(self, **values):
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    # Item assignment, so FieldExtractor fills the record directly
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def items(self):
+        # (field, value) of the fields that are set, in JOB_FIELDS order
+        for key in JOB_FIELDS:
+            try:
+                yield key, getattr(self, key)
+            except AttributeError:
+                pass
+
+    def __repr__(self):
+        return f"JobRecord(job_identifier={self.get('job_identifier')!r})"
+
+
+class JobRecordAdapter(AdapterInterface):
+    # Lets Scrapy and itemadapter treat a JobRecord as an item, like a JobItem
+    @classmethod
+    def is_item_class(cls, item_class):
+        return issubclass(item_class, JobRecord)
+
+    @classmethod
+    def get_field_meta_from_class(cls, item_class, field_name):
+        return ItemAdapter.get_field_meta_from_class(JobItem, field_name)
+
+    @classmethod
+    def get_field_names_from_class(cls, item_class):
+        return list(JOB_FIELDS)
+
+    def __getitem__(self, field_name):
+        return self.item[field_name]
+
+    def __setitem__(self, field_name, value):
+        if field_name not in JobItem.fields:
+            raise KeyError(f"{self.item.__class__.__name__} does not support field: {field_name}")
+        self.item[field_name] = value
+
+    def __delitem__(self, field_name):
+        try:
+            delattr(self.item, field_name)
+        except AttributeError:
+            raise KeyError(field_name) from None
+
+    def __iter__(self):
+        return (key for key, _ in self.item.items())
+
+    def __len__(self):
+        return sum(1 for _ in self.item.items())
+
+
+ItemAdapter.ADAPTER_CLASSES.appendleft(JobRecordAdapter)
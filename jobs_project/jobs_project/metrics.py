@@ -0,0 +1,134 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def cumulative_counts(self):
+        # Prometheus buckets count every observation less than or equal to their upper bound
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            yield total
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'buckets': dict(zip((str(bound) for bound in self.buckets), self.cumulative_counts())),
+        }
+
+class Metrics:
+    """Latency histograms and counters of a crawl. Safe to use from several threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # One per crawler, whoever asks first creates it. Every site of a multi-site run has its own
+        crawler_metrics = getattr(crawler, 'metrics', None)
+        if crawler_metrics is None:
+            crawler_metrics = cls()
+            crawler.metrics = crawler_metrics
+        return crawler_metrics
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, count=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+
+    def to_prometheus(self, prefix='jobs_'):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            described = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric_name = f"{prefix}{name}"
+                if metric_name not in described:
+                    lines.append(f"# TYPE {metric_name} histogram")
+                    described.add(metric_name)
+                for upper_bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    lines.append(f"{metric_name}_bucket{format_labels(labels + (('le', str(upper_bound)),))} {count}")
+                lines.append(f"{metric_name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{metric_name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric_name}_count{format_labels(labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                metric_name = f"{prefix}{name}"
+                if metric_name not in described:
+                    lines.append(f"# TYPE {metric_name} counter")
+                    described.add(metric_name)
+                lines.append(f"{metric_name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def timed(name, **labels):
+    # Method decorator recording the duration of every call in the metrics of the instance
+    # (self.metrics), labelled with the name of the method
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name, operation=function.__name__, **labels):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -3,7 +3,16 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
 from scrapy import signals
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.response import response_status_message
+from twisted.internet import task
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -101,3 +110,140 @@ class JobsProjectDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class AdaptiveThrottleRetryMiddleware:
+    """Adjusts the number of concurrent requests to the jobs API and retries failed requests.
+
+    Throttled responses (429, 503) halve the concurrency, other server errors or a latency well
+    above the best one seen take one request away, and healthy responses add one back, between
+    API_MIN_CONCURRENCY and API_MAX_CONCURRENCY. Failed requests are retried up to
+    API_RETRY_TIMES times after an exponential backoff with jitter (or the Retry-After header)."""
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = max(settings.getint('API_MIN_CONCURRENCY', 1), 1)
+        self.max_concurrency = max(settings.getint('API_MAX_CONCURRENCY', 16), self.min_concurrency)
+        self.concurrency = min(max(settings.getint('API_START_CONCURRENCY', 4), self.min_concurrency), self.max_concurrency)
+        self.max_retry_times = settings.getint('API_RETRY_TIMES', 5)
+        self.base_delay = settings.getfloat('API_RETRY_BASE_DELAY', 1.0)
+        self.max_delay = settings.getfloat('API_RETRY_MAX_DELAY', 60.0)
+        self.retry_http_codes = set(int(code) for code in settings.getlist('API_RETRY_HTTP_CODES', [429, 500, 502, 503, 504, 408]))
+        self.throttle_http_codes = {429, 503}
+        # The concurrency is reconsidered every adjust_interval responses
+        self.adjust_interval = settings.getint('API_ADJUST_INTERVAL', 10)
+
+        # Outcomes since the last adjustment and the smoothed download latency
+        self.responses = 0
+        self.throttled = 0
+        self.errors = 0
+        self.latency = None
+        self.best_latency = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('API_THROTTLE_ENABLED', True):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        self.apply_concurrency(request)
+        # A retried request waits for its backoff once, before it is downloaded
+        retry_times = request.meta.get('retry_times', 0)
+        if not retry_times or request.meta.get('retry_delayed_for') == retry_times:
+            return None
+        request.meta['retry_delayed_for'] = retry_times
+        delay = request.meta.pop('retry_after', None)
+        if delay is None:
+            delay = self.backoff_delay(retry_times)
+        self.stats.inc_value('api_throttle/retry_delay_seconds', delay)
+        from twisted.internet import reactor
+        return task.deferLater(reactor, delay, lambda: None)
+
+    def process_response(self, request, response, spider):
+        if 'download_latency' in request.meta:
+            self.observe_latency(request.meta['download_latency'])
+
+        if response.status in self.retry_http_codes:
+            if response.status in self.throttle_http_codes:
+                self.throttled += 1
+                self.stats.inc_value('api_throttle/throttled_responses')
+            else:
+                self.errors += 1
+                self.stats.inc_value('api_throttle/server_errors')
+            self.response_done(request)
+            retry_request = self.retry(request, response_status_message(response.status), spider)
+            if retry_request is None:
+                # Out of retries, the spider sees the error response and records the failed page
+                return response
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                retry_request.meta['retry_after'] = min(retry_after, self.max_delay)
+            return retry_request
+
+        self.response_done(request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # Timeouts, refused and dropped connections
+        if isinstance(exception, IgnoreRequest):
+            return None
+        self.errors += 1
+        self.stats.inc_value('api_throttle/download_errors')
+        self.response_done(request)
+        return self.retry(request, exception, spider)
+
+    def retry(self, request, reason, spider):
+        return get_retry_request(request, spider=spider, reason=reason, max_retry_times=self.max_retry_times)
+
+    def backoff_delay(self, retry_times):
+        # Exponential backoff with full jitter, so retried pages do not come back all at once
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry_times - 1)))
+
+    def observe_latency(self, latency):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+
+    def response_done(self, request):
+        self.responses += 1
+        if self.responses >= self.adjust_interval or self.throttled:
+            self.adjust_concurrency()
+        self.apply_concurrency(request)
+
+    def adjust_concurrency(self):
+        if self.throttled:
+            # The API asks to slow down
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        elif self.errors or (self.latency and self.best_latency and self.latency > 2 * self.best_latency):
+            # The server struggles, or more requests only make each one slower
+            self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        self.responses = self.throttled = self.errors = 0
+        self.stats.set_value('api_throttle/concurrency', self.concurrency)
+        self.stats.max_value('api_throttle/max_concurrency', self.concurrency)
+        self.stats.min_value('api_throttle/min_concurrency', self.concurrency)
+
+    def apply_concurrency(self, request):
+        # The downloader slot of the API host decides how many requests are in flight
+        key = request.meta.get('download_slot') or urlparse_cached(request).hostname
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = self.concurrency
+
+
+def retry_after_seconds(response):
+    # Retry-After holds either a number of seconds or an HTTP date
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -1,21 +1,226 @@
+import time
 from psycopg2.extras import Json
-from jobs_project.items import JobItem
-from database_managers.postgresql_manager import PostgreSQLManager
-from database_managers.mongodb_manager import MongoDBManager
+from twisted.internet import defer, task, threads
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
+from jobs_project.items import JOB_FIELDS, JobItem, JobRecord
+from jobs_project.metrics import Metrics
+from jobs_project.spool import Spool
+from database_managers.resources import DatabaseResources
+
+
+# Serialisers of a batch of records, one per store. Each store gets its own values,
+# the Json wrappers of PostgreSQL never reach the MongoDB documents
+def postgresql_rows(records):
+    # One tuple per record in JOB_FIELDS order, unset fields are NULL and nested structures JSON
+    rows = []
+    for record in records:
+        row = []
+        for key in JOB_FIELDS:
+            value = getattr(record, key, None)
+            row.append(Json(value) if isinstance(value, dict) else value)
+        rows.append(tuple(row))
+    return rows
+
+
+def mongodb_documents(records):
+    # One document per record with the fields that are set
+    return [dict(record.items()) for record in records]
+
+
+def spooled_records(documents):
+    # Records of the documents read back from the spool, fields that JobItem no longer has are dropped
+    return [JobRecord(**{key: value for key, value in document.items() if key in JobItem.fields}) for document in documents]
+
+
+class SpoolDrainer:
+    """Replays the spool into one store in bulk, from the offset of the store.
+
+    prepare sets the store up before its first write and write returns the number of documents the
+    store refused. Both raise when the store can not be reached: the drainer then tries again from
+    the same offset after retry_interval seconds, and the crawl goes on meanwhile."""
+
+    def __init__(self, name, spool, prepare, write, run_in_thread, batch_size=500, retry_interval=5.0, stats=None):
+        self.name = name
+        self.spool = spool
+        self.prepare = prepare
+        self.write = write
+        self.run_in_thread = run_in_thread
+        self.batch_size = max(batch_size, 1)
+        self.retry_interval = retry_interval
+        self.stats = stats
+        self.prepared = False
+        # Drain in progress, and whether documents were appended since it last read the spool
+        self.running = None
+        self.pending = False
+        self.retry_call = None
+        self.failing = False
+
+    def kick(self):
+        # Starts draining unless the drainer is already at it or waiting for its store to come back
+        if self.running is not None:
+            self.pending = True
+        elif not self.is_waiting():
+            self.pending = False
+            self.running = self.run_in_thread(self.drain)
+            self.running.addBoth(self.drained)
+
+    def is_waiting(self):
+        return self.retry_call is not None and self.retry_call.active()
+
+    def drain(self):
+        # Runs in a thread until the store has everything in the spool. Returns (written, failed)
+        if not self.prepared:
+            self.prepare()
+            self.prepared = True
+        written = failed = 0
+        while True:
+            documents, offset = self.spool.read(self.name, self.batch_size)
+            if not documents:
+                return written, failed
+            # Documents the store refuses would be refused again, only the unreachable store is retried
+            failed += self.write(documents) or 0
+            written += len(documents)
+            self.spool.commit(self.name, offset)
+
+    def drained(self, result):
+        self.running = None
+        if isinstance(result, failure.Failure):
+            # Logged once per outage, the drainer keeps trying quietly until the store is back
+            if not self.failing:
+                log.msg(f"Failed to replay the spool into {self.name}, retrying every {self.retry_interval}s. "
+                        f"Error: {result.type.__name__}: {result.getErrorMessage()}")
+            self.failing = True
+            if self.stats:
+                self.stats.inc_value(f'spool/{self.name}_retries')
+            from twisted.internet import reactor
+            self.retry_call = reactor.callLater(self.retry_interval, self.kick)
+            return
+        written, failed = result
+        if self.failing:
+            log.msg(f"Replaying the spool into {self.name} again")
+            self.failing = False
+        if self.stats:
+            self.stats.inc_value(f'spool/{self.name}_written', written)
+            if failed:
+                self.stats.inc_value(f'pipeline/{self.name}_failed_rows', failed)
+        if self.pending:
+            self.kick()
+
+    @defer.inlineCallbacks
+    def close(self):
+        # Last replay before the crawl ends, unless the store is known to be down.
+        # Whatever is left stays in the spool for the next crawl
+        while self.running is not None:
+            yield self.running
+        if not self.is_waiting():
+            self.kick()
+            while self.running is not None:
+                yield self.running
+        if self.retry_call is not None and self.retry_call.active():
+            self.retry_call.cancel()
+        backlog = self.spool.backlog(self.name)
+        if self.stats:
+            self.stats.set_value(f'spool/{self.name}_backlog_bytes', backlog)
+        if backlog:
+            log.msg(f"{backlog} bytes of items are left in the spool for {self.name}, they are written on the next crawl")
+
 
 class PostgreSQLMongoDBPipeline:
-    def __init__(self):
-        # Create instances of the database managers
-        self.postgres_manager = PostgreSQLManager()
-        self.mongo_manager = MongoDBManager()
+    def __init__(self, batch_size=1, flush_interval=0, stats=None, resources=None, max_pending_items=2000, settings=None,
+                 spool=None, drain_batch_size=500, retry_interval=5.0, metrics=None):
+        # Create instances of the database managers on the connection pools of the crawl,
+        # their writes are timed in the metrics of the crawl
+        resources = resources or DatabaseResources()
+        self.postgres_manager = resources.postgresql_manager(settings, metrics=metrics)
+        self.mongo_manager = resources.mongodb_manager(settings, metrics=metrics)
+
+        # Items are buffered and written in bulk once batch_size items are collected
+        # or flush_interval seconds have passed since the last flush. A batch_size of 1
+        # writes every item as soon as it arrives
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush_time = time.monotonic()
+        self.flush_loop = None
+        # Rows that could not be written are counted in the crawl stats
+        self.stats = stats
+
+        # The writes run in threads so the reactor keeps downloading and parsing meanwhile.
+        # One thread per database, plus one for the spool appends when there is a spool. The lock of
+        # each database keeps its batches in order and its manager (a single connection) out of two
+        # threads at once, the lock of the spool keeps the appends in order
+        self.thread_pool = ThreadPool(minthreads=0, maxthreads=3 if spool else 2, name='pipeline-writes')
+        # Handle of the shutdown trigger that stops the pool, removed again when the spider closes
+        self.shutdown_trigger = None
+        self.postgres_lock = defer.DeferredLock()
+        self.mongo_lock = defer.DeferredLock()
+        self.spool_lock = defer.DeferredLock()
+        # Batches handed to the threads and not written yet
+        self.pending_writes = set()
+        self.pending_items = 0
+        # When more than max_pending_items items wait to be written, process_item holds the new
+        # items back. Scrapy then stops scheduling downloads, so slow databases slow the crawl
+        # down instead of filling the memory
+        self.max_pending_items = max(max_pending_items, 1)
+        self.waiting_items = []
+
+        # With a spool the items are appended to it and a drainer per store writes them from there,
+        # a store that is down falls behind instead of losing items or slowing the crawl down
+        self.spool = spool
+        self.drainers = []
+        if spool:
+            self.drainers = [
+                SpoolDrainer('postgresql', spool, self.prepare_postgresql, self.drain_postgresql,
+                             self.run_in_thread, drain_batch_size, retry_interval, stats),
+                SpoolDrainer('mongodb', spool, self.prepare_mongodb, self.drain_mongodb,
+                             self.run_in_thread, drain_batch_size, retry_interval, stats),
+            ]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            batch_size=crawler.settings.getint('PIPELINE_BATCH_SIZE', 1),
+            flush_interval=crawler.settings.getfloat('PIPELINE_FLUSH_INTERVAL', 0),
+            stats=crawler.stats,
+            resources=DatabaseResources.from_crawler(crawler),
+            max_pending_items=crawler.settings.getint('PIPELINE_MAX_PENDING_ITEMS', 2000),
+            settings=crawler.settings,
+            spool=Spool.from_crawler(crawler, ('postgresql', 'mongodb')) if crawler.settings.getbool('SPOOL_ENABLED') else None,
+            drain_batch_size=crawler.settings.getint('SPOOL_DRAIN_BATCH_SIZE', 500),
+            retry_interval=crawler.settings.getfloat('SPOOL_RETRY_INTERVAL', 5.0),
+            metrics=Metrics.from_crawler(crawler),
+        )
 
     def open_spider(self, spider):
+        from twisted.internet import reactor
+        self.thread_pool.start()
+        # Do not keep the process alive when the reactor stops without closing the spider
+        self.shutdown_trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.stop_thread_pool)
+
+        if self.spool:
+            # The drainers set the stores up once they can reach them, and write what a previous crawl left in the spool
+            for drainer in self.drainers:
+                drainer.kick()
+        else:
+            self.prepare_postgresql()
+            self.prepare_mongodb()
+
+        # Periodically flush the buffer so that items do not wait for a full batch when the crawl slows down
+        if self.batch_size > 1 and self.flush_interval > 0:
+            self.flush_loop = task.LoopingCall(self.flush_if_due)
+            self.flush_loop.start(self.flush_interval, now=False)
+
+    def prepare_postgresql(self):
+        if not self.postgres_manager.ensure_connection():
+            raise ConnectionError("PostgreSQL is unreachable")
         # PostgreSQL
         # Create the raw_table if it doesn't exist
         create_table_query = f"""
                       CREATE TABLE IF NOT EXISTS {self.postgres_manager.table_name} (
             id SERIAL PRIMARY KEY,
             job_identifier TEXT,
+            content_hash TEXT,
             slug VARCHAR(255),
             language VARCHAR(10),
             languages VARCHAR(255)[],
@@ -70,32 +275,147 @@ class PostgreSQLMongoDBPipeline:
         
         """
         self.postgres_manager.create_table(create_table_query)
- 
+        # Tables created before content fingerprints were introduced
+        self.postgres_manager.add_column_if_not_exists('content_hash', 'TEXT')
+
+        # Unique indexes on job_identifier make the writes idempotent upserts and the deletes index lookups
+        self.postgres_manager.create_unique_index('job_identifier')
+        # Changes to the table bump its generation, the spider uses it to skip reloading the identifiers
+        self.postgres_manager.create_generation_counter()
+
+    def prepare_mongodb(self):
+        if self.spool:
+            # Raises when MongoDB can not be reached, the drainer tries again later
+            self.mongo_manager.mongo_db.command('ping')
+        self.mongo_manager.create_unique_index('job_identifier')
 
     def process_item(self, item, spider):
-        if isinstance(item, JobItem):
-            values = dict(item)
-            # Exclude the 'id' column from the list of columns and values
-            id_column = 'id'
-            values.pop(id_column, None)
-            mongodb_values = values
-
-            # Convert nested structures to JSON for PostgreSQL
-            for key, value in values.items():
-                if isinstance(value, dict):
-                    values[key] = Json(value)
-    
-            # PostgreSQL insertion
-            self.postgres_manager.insert_values(values)
-            
-            # MongoDB insertion
-            self.mongo_manager.insert_values(mongodb_values)
+        if isinstance(item, (JobRecord, JobItem)):
+            # Records are buffered as they are and only serialised per store when the batch is written
+            self.buffer.append(item if isinstance(item, JobRecord) else JobRecord(**item))
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+            if self.pending_items >= self.max_pending_items:
+                # Handed back to Scrapy once the writes have caught up
+                waiting_item = defer.Deferred()
+                self.waiting_items.append((waiting_item, item))
+                return waiting_item
         return item
-    
-    
+
+    def flush_if_due(self):
+        if self.buffer and time.monotonic() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.monotonic()
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+
+        if self.spool:
+            # The items are safe once they are in the spool, the drainers take it from there.
+            # The batch is serialised and appended in a thread, one append at a time
+            append = self.spool_lock.run(self.write_in_thread, self.append_to_spool, batch)
+            write = defer.DeferredList([append], consumeErrors=True)
+            self.pending_writes.add(write)
+            self.pending_items += len(batch)
+            write.addCallback(self.batch_spooled, write, len(batch))
+            return
+
+        # Changed jobs come with the same job_identifier as the stored version, so the stored
+        # version is overwritten instead of inserting a second copy
+        postgres_write = self.postgres_lock.run(self.write_in_thread, self.write_postgresql, batch)
+        mongo_write = self.mongo_lock.run(self.write_in_thread, self.write_mongodb, batch)
+
+        write = defer.DeferredList([postgres_write, mongo_write], consumeErrors=True)
+        self.pending_writes.add(write)
+        self.pending_items += len(batch)
+        write.addCallback(self.batch_written, write, len(batch))
+
+    def write_in_thread(self, function, records):
+        return self.run_in_thread(function, records)
+
+    def run_in_thread(self, function, *args):
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.thread_pool, function, *args)
+
+    def write_postgresql(self, records):
+        # PostgreSQL insertion, runs in a thread of the pool. Returns the number of rows that failed
+        return self.postgres_manager.upsert_many_rows(JOB_FIELDS, postgresql_rows(records))
+
+    def write_mongodb(self, records):
+        # MongoDB insertion, runs in a thread of the pool
+        self.mongo_manager.upsert_many_values(mongodb_documents(records))
+
+    def append_to_spool(self, records):
+        # Runs in a thread of the pool
+        self.spool.append(mongodb_documents(records))
+
+    def drain_postgresql(self, documents):
+        # Writes a batch read back from the spool, raises when PostgreSQL can not be reached
+        if not self.postgres_manager.ensure_connection():
+            raise ConnectionError("PostgreSQL is unreachable")
+        return self.postgres_manager.upsert_many_rows(JOB_FIELDS, postgresql_rows(spooled_records(documents)))
+
+    def drain_mongodb(self, documents):
+        return self.mongo_manager.upsert_many_values(documents)
+
+    def batch_written(self, results, write, batch_length):
+        self.pending_writes.discard(write)
+        self.pending_items -= batch_length
+        for success, result in results:
+            if not success:
+                log.err(result, "Failed to write a batch of items")
+        (postgres_success, failed_rows), _ = results
+        if not postgres_success:
+            failed_rows = batch_length
+        if failed_rows and self.stats:
+            self.stats.inc_value('pipeline/postgresql_failed_rows', failed_rows)
+        self.release_waiting_items()
+
+    def batch_spooled(self, results, write, batch_length):
+        self.pending_writes.discard(write)
+        self.pending_items -= batch_length
+        (success, result), = results
+        if success:
+            for drainer in self.drainers:
+                drainer.kick()
+        else:
+            log.err(result, "Failed to append a batch of items to the spool")
+            if self.stats:
+                self.stats.inc_value('pipeline/spool_failed_rows', batch_length)
+        self.release_waiting_items()
+
+    def release_waiting_items(self):
+        # Let the held back items go on
+        while self.waiting_items and self.pending_items < self.max_pending_items:
+            waiting_item, item = self.waiting_items.pop(0)
+            waiting_item.callback(item)
+
+    def stop_thread_pool(self):
+        if self.thread_pool.started:
+            self.thread_pool.stop()
+
+    def remove_shutdown_trigger(self):
+        # The scheduler runs a crawl after another in the same reactor, every crawl removes its trigger
+        from twisted.internet import reactor
+        if self.shutdown_trigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.shutdown_trigger = None
+
+    @defer.inlineCallbacks
     def close_spider(self, spider):
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+        # Write whatever is left in the buffer and wait for every write to finish
+        self.flush()
+        while self.pending_writes:
+            yield defer.DeferredList(list(self.pending_writes))
+        if self.spool:
+            yield defer.DeferredList([drainer.close() for drainer in self.drainers])
+            self.spool.close()
+        self.stop_thread_pool()
+        self.remove_shutdown_trigger()
+
         self.postgres_manager.close_connection()
         self.mongo_manager.close_connection()
-    
-
-
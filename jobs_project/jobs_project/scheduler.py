@@ -0,0 +1,289 @@
+"""Long-running crawl scheduler.
+
+Replaces the scraping_timer.sh loop: one process keeps the reactor, the CrawlerRunner and the
+export connections alive and starts the crawl on an interval or a cron expression, followed by
+the export of query.py. With SITES_FILE every site of the file is crawled in the same cycle, by
+concurrent crawlers sharing the reactor and the connection pools. Run it from the jobs_project directory:
+
+    python -m jobs_project.scheduler
+"""
+import importlib.util
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Default location of query.py, at the root of the repository
+EXPORT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'query.py')
+
+
+class IntervalSchedule:
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_time(self, after):
+        return after + timedelta(seconds=self.interval)
+
+    def __str__(self):
+        return f"every {self.interval} seconds"
+
+
+class CronSchedule:
+    """Standard five field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept *, numbers, ranges (1-5), lists (1,15) and steps (*/10, 0-30/5).
+    Like cron, when both day fields are restricted a day matching either of them fires."""
+
+    # Allowed values of every field
+    field_ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"A cron expression needs 5 fields, got {expression!r}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.field_ranges)
+        )
+        # Both 0 and 7 are Sunday
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(value) for value in value_range.split('-', 1))
+            else:
+                start = end = int(value_range)
+                # A single value with a step runs until the end of the range, like 5/15
+                if step:
+                    end = high
+            if start < low or end > high or start > end:
+                raise ValueError(f"Invalid cron field {field!r}, values must be between {low} and {high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def day_matches(self, moment):
+        # Python counts the weekdays from Monday = 0, cron from Sunday = 0
+        day_matches = moment.day in self.days
+        weekday_matches = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday_matches
+        if self.any_weekday:
+            return day_matches
+        return day_matches or weekday_matches
+
+    def next_time(self, after):
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Jump a day or an hour at a time where nothing can match, five years is enough for any valid expression
+        limit = moment + timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self.months or not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"The cron expression {self.expression!r} never fires")
+
+    def __str__(self):
+        return f"cron '{self.expression}'"
+
+
+def load_export_module(path):
+    # query.py is a standalone script outside of the package, so it is loaded from its path
+    spec = importlib.util.spec_from_file_location('query', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CrawlScheduler:
+    def __init__(self, settings):
+        from scrapy.crawler import CrawlerRunner
+        from database_managers.resources import DatabaseResources
+
+        from jobs_project.sites import load_sites
+
+        self.settings = settings
+        # One runner for the lifetime of the process, every cycle only creates new crawlers
+        self.runner = CrawlerRunner(settings)
+        # Sites crawled in every cycle, none for the single site of the settings
+        self.sites = load_sites(settings.get('SITES_FILE')) if settings.get('SITES_FILE') else []
+        # At most this many sites are crawled at the same time
+        self.site_concurrency = max(settings.getint('SITES_CONCURRENT_CRAWLS', 4), 1)
+        # The connection pools are shared by every crawl and export instead of being reopened each cycle.
+        # The spider and the pipeline of every site running at once need a PostgreSQL connection each
+        resource_settings = settings.copy()
+        if self.sites:
+            resource_settings.set('POSTGRES_POOL_MAX_SIZE', max(settings.getint('POSTGRES_POOL_MAX_SIZE', 5),
+                                                                2 * min(self.site_concurrency, len(self.sites)) + 1))
+        self.resources = DatabaseResources(resource_settings)
+        cron_expression = settings.get('SCHEDULE_CRON')
+        if cron_expression:
+            self.schedule = CronSchedule(cron_expression)
+        else:
+            self.schedule = IntervalSchedule(settings.getfloat('SCHEDULE_INTERVAL', 300))
+        # Random delay added to every run, so several schedulers do not hit the website at the same moment
+        self.jitter = settings.getfloat('SCHEDULE_JITTER', 0)
+        self.run_on_start = settings.getbool('SCHEDULE_RUN_ON_START', True)
+
+        # The export runs after every crawl: 'incremental', 'full' or 'none'
+        self.export_mode = settings.get('SCHEDULE_EXPORT', 'incremental')
+        self.export_format = settings.get('EXPORT_FORMAT', 'csv')
+        self.export_module = None
+        if self.export_mode != 'none':
+            self.export_module = load_export_module(settings.get('EXPORT_SCRIPT') or EXPORT_SCRIPT)
+        self.running = False
+        self.next_call = None
+
+    def start(self):
+        from twisted.internet import reactor
+
+        sites = f" of {len(self.sites)} sites" if self.sites else ''
+        logger.info(f"Scheduling the crawl{sites} {self.schedule}")
+        # Let a running crawl finish its flushes and close its connections on shutdown
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        if self.run_on_start:
+            reactor.callWhenRunning(self.tick, datetime.now())
+        else:
+            self.schedule_next(datetime.now())
+
+    def stop(self):
+        if self.next_call and self.next_call.active():
+            self.next_call.cancel()
+        deferred = self.runner.stop()
+        # An export thread may still be using the connections, they are closed with the process then
+        if not self.running:
+            deferred.addBoth(lambda _: self.resources.close())
+        return deferred
+
+    def schedule_next(self, after):
+        from twisted.internet import reactor
+
+        next_time = self.schedule.next_time(after)
+        # After a stall (a suspended machine, a crawl longer than the interval) missed runs are not caught up
+        if next_time < datetime.now():
+            next_time = self.schedule.next_time(datetime.now())
+        delay = max((next_time - datetime.now()).total_seconds(), 0) + random.uniform(0, self.jitter)
+        logger.info(f"Next crawl at {next_time:%Y-%m-%d %H:%M:%S} (+{delay:.0f} seconds)")
+        self.next_call = reactor.callLater(delay, self.tick, next_time)
+
+    def tick(self, scheduled_time):
+        # The next run is planned from the scheduled time, so slow crawls do not shift the schedule
+        self.schedule_next(scheduled_time)
+        if self.running:
+            logger.warning("The previous crawl is still running, skipping this run")
+            return
+        self.running = True
+        deferred = self.run_cycle()
+        deferred.addErrback(self.cycle_failed)
+        deferred.addBoth(self.cycle_finished)
+
+    def run_cycle(self):
+        from twisted.internet import defer
+
+        if not self.sites:
+            return self.crawl_site(None)
+        # Every site runs as its own crawl, a failing site does not stop the others
+        semaphore = defer.DeferredSemaphore(self.site_concurrency)
+        crawls = []
+        for site in self.sites:
+            deferred = semaphore.run(self.crawl_site, site)
+            deferred.addErrback(self.site_failed, site)
+            crawls.append(deferred)
+        return defer.DeferredList(crawls)
+
+    def crawl_site(self, site):
+        from scrapy.crawler import Crawler
+        from twisted.internet import defer, threads
+
+        @defer.inlineCallbacks
+        def crawl():
+            start_time = time.monotonic()
+            name = f" of {site}" if site else ''
+            logger.info(f"Running the crawl{name}")
+            if site:
+                crawler = Crawler(self.runner.spider_loader.load('job_spider'), site.crawler_settings(self.settings))
+                crawl_kwargs = site.spider_kwargs()
+            else:
+                crawler = self.runner.create_crawler('job_spider')
+                crawl_kwargs = {}
+            crawler.database_resources = self.resources
+            yield self.runner.crawl(crawler, **crawl_kwargs)
+            logger.info(f"Crawl{name} finished in {time.monotonic() - start_time:.1f} seconds, "
+                        f"{crawler.stats.get_value('item_scraped_count', 0)} items stored")
+
+            # With several workers only the last one to finish the round exports it
+            last_worker = crawler.stats.get_value('crawl_round/last_worker', False)
+            if self.export_module is not None and (last_worker or not self.settings.getbool('CRAWL_DISTRIBUTED')):
+                # The export is blocking, a thread keeps the reactor responsive meanwhile
+                export_start_time = time.monotonic()
+                yield threads.deferToThread(self.export, site)
+                logger.info(f"Export{name} finished in {time.monotonic() - export_start_time:.1f} seconds")
+        return crawl()
+
+    def site_failed(self, failure, site):
+        logger.error(f"Crawl of {site} failed: {failure.getErrorMessage()}",
+                     exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
+    def cycle_failed(self, failure):
+        logger.error(f"Crawl cycle failed: {failure.getErrorMessage()}",
+                     exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
+    def cycle_finished(self, result):
+        self.running = False
+
+    def export(self, site=None):
+        # The export borrows a connection of the pool and the Mongo client of the crawls
+        pool = self.resources.postgres_pool
+        connection = pool.getconn()
+        try:
+            pg_db = self.export_module.Postgresql(conn=connection)
+            mongo_db = self.export_module.MongoDB(
+                dbname=self.settings.get('MONGO_DB'),
+                collection_name=site.collection if site else self.settings.get('MONGO_COLLECTION_NAME'),
+                client=self.resources.mongo_client,
+            )
+            if site:
+                # Every site has its own output files and export state
+                self.export_module.run_export(pg_db, mongo_db, self.export_format, self.export_mode == 'incremental',
+                                              pg_table_name=site.table, output_prefix=f"output_data_{site.name}",
+                                              state_filename=f"export_state_{site.name}.json")
+            else:
+                self.export_module.run_export(pg_db, mongo_db, self.export_format, self.export_mode == 'incremental')
+            pg_db.cur.close()
+        finally:
+            # A broken connection is dropped by the pool, the next export gets a new one
+            pool.putconn(connection, close=bool(connection.closed))
+
+
+def main():
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+    from scrapy.utils.reactor import install_reactor
+
+    settings = get_project_settings()
+    configure_logging(settings)
+    # The reactor of the settings has to be installed before anything imports the default one
+    install_reactor(settings.get('TWISTED_REACTOR'))
+    from twisted.internet import reactor
+
+    scheduler = CrawlScheduler(settings)
+    scheduler.start()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,42 @@ ROBOTSTXT_OBEY = False
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 FEED_EXPORT_ENCODING = "utf-8"
 
+# Pagination of the jobs API: 'concurrent' requests every page once the total job count
+# is known from the first page, 'serial' requests each page after the previous one
+PAGINATION_MODE = os.getenv('PAGINATION_MODE', 'concurrent')
+# Maximum number of pages in flight in concurrent mode (0 requests all pages up front)
+PAGINATION_WINDOW = int(os.getenv('PAGINATION_WINDOW', 0))
+CONCURRENT_REQUESTS = 16
+CONCURRENT_REQUESTS_PER_DOMAIN = 16
+
+# The API middleware adapts the concurrency between these bounds to the latency and the
+# 429/5xx responses of the API, and retries failed requests with exponential backoff.
+# It replaces Scrapy's RetryMiddleware
+API_THROTTLE_ENABLED = os.getenv('API_THROTTLE_ENABLED', 'true').lower() == 'true'
+if API_THROTTLE_ENABLED:
+    DOWNLOADER_MIDDLEWARES = {
+        'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+        'jobs_project.middlewares.AdaptiveThrottleRetryMiddleware': 550,
+    }
+API_MIN_CONCURRENCY = 1
+API_START_CONCURRENCY = 4
+API_MAX_CONCURRENCY = CONCURRENT_REQUESTS_PER_DOMAIN
+API_RETRY_TIMES = int(os.getenv('API_RETRY_TIMES', 5))
+# The backoff doubles from API_RETRY_BASE_DELAY seconds with every retry, up to API_RETRY_MAX_DELAY
+API_RETRY_BASE_DELAY = 1.0
+API_RETRY_MAX_DELAY = 60.0
+API_RETRY_HTTP_CODES = [429, 500, 502, 503, 504, 408]
+
+# Pages are requested with the ETag/Last-Modified of the previous crawl, and a page that has not
+# changed (304 or the same body) only marks its jobs as active, without being decoded
+PAGE_CACHE_ENABLED = os.getenv('PAGE_CACHE_ENABLED', 'true').lower() == 'true'
+
+# Closed jobs (stored but not seen in the crawl) are only deleted when the crawl had no failed page
+# and saw at least SWEEP_MIN_COMPLETENESS of the total count reported by the API. A sweep that would
+# delete more than SWEEP_MAX_DELETE_RATIO of the stored jobs is refused
+SWEEP_MIN_COMPLETENESS = float(os.getenv('SWEEP_MIN_COMPLETENESS', 0.95))
+SWEEP_MAX_DELETE_RATIO = float(os.getenv('SWEEP_MAX_DELETE_RATIO', 0.2))
+
 # Set to 'DEBUG' for more details
 LOG_LEVEL = 'INFO'
 
@@ -25,6 +61,9 @@ POSTGRES_DB = os.getenv('POSTGRES_DB')
 POSTGRES_USER = os.getenv('POSTGRES_USER')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
 POSTGRES_TABLE_NAME = os.getenv('POSTGRES_TABLE_NAME')
+# Connections kept open in the pool shared by the spider, the pipeline and the export, and the most open at once
+POSTGRES_POOL_MIN_SIZE = int(os.getenv('POSTGRES_POOL_MIN_SIZE', 2))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv('POSTGRES_POOL_MAX_SIZE', 5))
 
 # MongoDB parameters
 MONGO_HOST = os.getenv('MONGO_HOST')
@@ -33,16 +72,102 @@ MONGO_DB = os.getenv('MONGO_DB')
 MONGO_COLLECTION_NAME = os.getenv('MONGO_COLLECTION_NAME')
 MONGO_USERNAME = os.getenv('MONGO_USERNAME')
 MONGO_PASSWORD = os.getenv('MONGO_PASSWORD')
+# Connection pool size of the single MongoClient of a crawl
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 10))
 
 # Configure pipelines
 ITEM_PIPELINES = {
     'jobs_project.pipelines.PostgreSQLMongoDBPipeline': 300,
 }
 
+# Number of items written to the databases in a single batch (1 disables buffering)
+PIPELINE_BATCH_SIZE = int(os.getenv('PIPELINE_BATCH_SIZE', 500))
+# Maximum number of seconds an item waits in the buffer before it is written
+PIPELINE_FLUSH_INTERVAL = float(os.getenv('PIPELINE_FLUSH_INTERVAL', 5))
+# The writes run in background threads. Past this many items waiting to be written new items
+# are held back, which makes Scrapy pause the downloads until the databases catch up
+PIPELINE_MAX_PENDING_ITEMS = int(os.getenv('PIPELINE_MAX_PENDING_ITEMS', 2000))
+
+# Write-ahead spool: the items are appended to local files first and replayed into each store
+# by a background drainer, so a store that is down does not lose items or stop the crawl
+SPOOL_ENABLED = os.getenv('SPOOL_ENABLED', 'true').lower() == 'true'
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+# A new segment file is started past this size, segments read by every store are deleted
+SPOOL_SEGMENT_SIZE = int(os.getenv('SPOOL_SEGMENT_SIZE', 64 * 1024 * 1024))
+# The appends are fsynced at most this often, in seconds (0 fsyncs every append)
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', 1.0))
+# Items replayed into a store per bulk write
+SPOOL_DRAIN_BATCH_SIZE = int(os.getenv('SPOOL_DRAIN_BATCH_SIZE', 500))
+# Seconds before a drainer tries again a store it could not reach
+SPOOL_RETRY_INTERVAL = float(os.getenv('SPOOL_RETRY_INTERVAL', 5))
+
+# Latency and throughput metrics of each crawl, exposed through the Scrapy stats and
+# written to these files when the crawl ends (leave empty to skip a file). In a multi-site
+# run every site writes its own files, named after it (crawl_metrics_<site>.json)
+EXTENSIONS = {
+    'jobs_project.extensions.CrawlMetricsExtension': 500,
+}
+METRICS_JSON_FILE = os.getenv('METRICS_JSON_FILE', 'crawl_metrics.json')
+METRICS_PROMETHEUS_FILE = os.getenv('METRICS_PROMETHEUS_FILE', 'crawl_metrics.prom')
+
+# Scheduler (python -m jobs_project.scheduler): the crawl runs every SCHEDULE_INTERVAL
+# seconds, or on the SCHEDULE_CRON expression when it is set (e.g. '*/5 * * * *')
+SCHEDULE_INTERVAL = float(os.getenv('SCHEDULE_INTERVAL', 300))
+SCHEDULE_CRON = os.getenv('SCHEDULE_CRON')
+# Random delay of up to this many seconds added to every run
+SCHEDULE_JITTER = float(os.getenv('SCHEDULE_JITTER', 0))
+SCHEDULE_RUN_ON_START = os.getenv('SCHEDULE_RUN_ON_START', 'true').lower() == 'true'
+# Export run after every crawl: 'incremental', 'full' or 'none'
+SCHEDULE_EXPORT = os.getenv('SCHEDULE_EXPORT', 'incremental')
+EXPORT_FORMAT = os.getenv('EXPORT_FORMAT', 'csv')
+
+# Where the spider keeps the known, seen and cached identifiers, the fingerprints and the page cache.
+# jobs_project.dedup.RedisDedupBackend is shared by several workers, jobs_project.dedup.SQLiteDedupBackend
+# keeps them in a local SQLite file (DEDUP_SQLITE_PATH) behind an in-memory Bloom filter
+DEDUP_BACKEND = os.getenv('DEDUP_BACKEND', 'jobs_project.dedup.RedisDedupBackend')
+DEDUP_SQLITE_PATH = os.getenv('DEDUP_SQLITE_PATH', 'job_identifiers.sqlite3')
+DEDUP_BLOOM_ERROR_RATE = float(os.getenv('DEDUP_BLOOM_ERROR_RATE', 0.001))
+
+# Feed of the jobs added, updated and removed by every crawl, in the order the spider finds them.
+# jobs_project.changes.FileChangeFeed appends them as JSON lines to CHANGE_FEED_PATH,
+# jobs_project.changes.RedisStreamChangeFeed adds them to the job_changes Redis Stream
+# (trimmed to about CHANGE_FEED_MAXLEN events, 0 keeps them all). Leave empty to disable it.
+# Distributed workers (CRAWL_DISTRIBUTED) share the stream, a local file is refused
+CHANGE_FEED_BACKEND = os.getenv('CHANGE_FEED_BACKEND', 'jobs_project.changes.RedisStreamChangeFeed'
+                                if os.getenv('CRAWL_DISTRIBUTED', 'false').lower() == 'true' else 'jobs_project.changes.FileChangeFeed')
+CHANGE_FEED_PATH = os.getenv('CHANGE_FEED_PATH', 'job_changes.ndjson')
+CHANGE_FEED_MAXLEN = int(os.getenv('CHANGE_FEED_MAXLEN', 100000))
+# The file is rotated once it holds this many bytes (0 never rotates it), and only the newest
+# CHANGE_FEED_MAX_FILES rotated files are kept
+CHANGE_FEED_MAX_BYTES = int(os.getenv('CHANGE_FEED_MAX_BYTES', 64 * 1024 * 1024))
+CHANGE_FEED_MAX_FILES = int(os.getenv('CHANGE_FEED_MAX_FILES', 5))
+
+# JSON list of Jibe career sites crawled together by the scheduler, each with its own table, collection,
+# concurrency and Redis namespace (see jobs_project/sites.py). Empty crawls the FedEx site of the spider
+SITES_FILE = os.getenv('SITES_FILE')
+# Most sites crawled at the same time
+SITES_CONCURRENT_CRAWLS = int(os.getenv('SITES_CONCURRENT_CRAWLS', 4))
+
+# Several workers (processes or containers with the same settings) can crawl the website together.
+# The first worker of a round plans it and shares the pages in shards of CRAWL_SHARD_PAGES pages
+# through Redis, the others take shards until none are left. Needs the Redis dedup backend
+CRAWL_DISTRIBUTED = os.getenv('CRAWL_DISTRIBUTED', 'false').lower() == 'true'
+CRAWL_WORKER_ID = os.getenv('CRAWL_WORKER_ID')
+CRAWL_SHARD_PAGES = int(os.getenv('CRAWL_SHARD_PAGES', 10))
+# Seconds between two checks of a worker waiting for the planner
+CRAWL_POLL_INTERVAL = float(os.getenv('CRAWL_POLL_INTERVAL', 1.0))
+# The keys of a round whose workers died expire after this many seconds
+CRAWL_ROUND_TIMEOUT = int(os.getenv('CRAWL_ROUND_TIMEOUT', 3600))
+# A worker that has not written its heartbeat for this many seconds is taken for dead: its shard
+# goes to another worker, and a round it planned without sharing the pages is abandoned
+CRAWL_LEASE_TIMEOUT = int(os.getenv('CRAWL_LEASE_TIMEOUT', 60))
+
 # REDIS parameters
 REDIS_HOST = os.getenv('REDIS_HOST')
 REDIS_PORT = int(os.getenv('REDIS_PORT'))
 REDIS_DB = os.getenv('REDIS_DB')
+# Size of the Redis connection pool shared by the managers of a crawl
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 10))
 
 # Configure Redis as a caching backend
 REDIS_URL = 'redis://redis:6379/0' 
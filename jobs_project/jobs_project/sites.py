@@ -0,0 +1,73 @@
+"""Career sites crawled together by the scheduler.
+
+Every site is a Jibe-hosted career page with the same /api/jobs endpoint as careers.fedex.com.
+SITES_FILE points to a JSON list of site configs:
+
+    [
+        {"name": "fedex", "host": "careers.fedex.com", "domain": "fedex.jibeapply.com",
+         "table": "raw_table", "collection": "raw_collection", "concurrency": 8},
+        {"name": "acme", "host": "careers.acme.com", "domain": "acme.jibeapply.com"}
+    ]
+
+Each site gets its own crawler with its own settings: its table and collection, its download
+concurrency, and SITE_NAME, which namespaces its identifiers, page cache and crawl rounds in Redis.
+The closed jobs of a site are only swept from its own table and collection.
+"""
+import json
+import re
+
+# The table and collection names end up in SQL statements, only plain identifiers are accepted
+NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+JOBS_API_URL = 'https://{host}/api/jobs?page={page}&sortBy=relevance&descending=false{featured}&internal=false&deviceId=undefined&domain={domain}'
+
+
+class SiteConfig:
+    def __init__(self, name, host=None, domain=None, base_url=None, page_url=None, table=None, collection=None, concurrency=None):
+        self.name = name
+        self.table = table or f"{name}_jobs"
+        self.collection = collection or f"{name}_jobs"
+        for value in (self.name, self.table, self.collection):
+            if not NAME_PATTERN.match(value):
+                raise ValueError(f"Invalid name {value!r} in the config of site {name!r}")
+        if not (base_url and page_url) and not (host and domain):
+            raise ValueError(f"Site {name!r} needs a host and a domain, or a base_url and a page_url")
+        # First url is for featured jobs, the regular jobs are paginated with page_url
+        self.base_url = base_url or JOBS_API_URL.format(host=host, domain=domain, page=1, featured='&featured=true')
+        self.page_url = page_url or JOBS_API_URL.format(host=host, domain=domain, page='{}', featured='')
+        # Most requests in flight to the site at once, the API middleware adapts below it
+        self.concurrency = concurrency
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(**config)
+
+    def crawler_settings(self, settings):
+        # Copy of the project settings for the crawler of this site
+        site_settings = settings.copy()
+        site_settings.set('SITE_NAME', self.name)
+        site_settings.set('POSTGRES_TABLE_NAME', self.table)
+        site_settings.set('MONGO_COLLECTION_NAME', self.collection)
+        if self.concurrency:
+            site_settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', self.concurrency)
+            site_settings.set('API_MAX_CONCURRENCY', self.concurrency)
+            site_settings.set('API_START_CONCURRENCY', min(settings.getint('API_START_CONCURRENCY', 4), self.concurrency))
+        return site_settings
+
+    def spider_kwargs(self):
+        return {'base_url': self.base_url, 'page_url': self.page_url}
+
+    def __str__(self):
+        return self.name
+
+
+def load_sites(path):
+    with open(path) as sites_file:
+        sites = [SiteConfig.from_dict(config) for config in json.load(sites_file)]
+    # Two sites writing to the same table would sweep each other's jobs
+    for attribute in ('name', 'table', 'collection'):
+        values = [getattr(site, attribute) for site in sites]
+        duplicates = sorted({value for value in values if values.count(value) > 1})
+        if duplicates:
+            raise ValueError(f"Duplicate site {attribute}s in {path}: {', '.join(duplicates)}")
+    return sites
@@ -1,28 +1,78 @@
 import json
+import math
+import time
+import hashlib
 import scrapy
-from jobs_project.items import JobItem
-import os
+from scrapy import signals
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.misc import load_object
+from twisted.internet import task
+from jobs_project.items import JobItem, JobRecord
+from jobs_project.metrics import Metrics
 import psycopg2
-from database_managers.postgresql_manager import PostgreSQLManager
-from database_managers.mongodb_manager import MongoDBManager
-from database_managers.redis_manager import RedisManager
+from database_managers.resources import DatabaseResources
+from jobs_project.dedup import RedisDedupBackend
+from jobs_project.coordinator import CrawlCoordinator
+from jobs_project.changes import ADDED, REMOVED, UPDATED, FileChangeFeed, change_event
+
+# orjson decodes the API responses several times faster, json is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ### HELPERS ####
-# Recursively flatten a nested dictionary, also name the 
-# keys with respect to their position to avoid aliasing
-def flatten_dict(data, parent_key='', sep='_'):
-    flattened_data = {}
-    for key, value in data.items():
-        new_key = f"{parent_key}{sep}{key}" if parent_key else key
-        if isinstance(value, dict):
-            flattened_data.update(flatten_dict(value, new_key, sep=sep))
-        else:
-            flattened_data[new_key] = value          
-    return flattened_data
+# Pull the allowed keys out of a nested dictionary as if it was flattened, naming the keys
+# with respect to their position to avoid aliasing (meta_data -> googlejobs -> jobName is
+# meta_data_googlejobs_jobName). Only one pass and no intermediate dictionaries: subtrees
+# that can not hold an allowed key (most of meta_data) are skipped instead of being flattened
+class FieldExtractor:
+    def __init__(self, allowed_keys, sep='_'):
+        self.allowed_keys = frozenset(allowed_keys)
+        self.sep = sep
+        # Every flattened key an allowed key can be nested under. Keys contain the separator too,
+        # so all the prefixes ending before a separator are kept (meta, meta_data, meta_data_googlejobs)
+        self.nested_keys = frozenset(
+            key[:index] for key in self.allowed_keys for index, char in enumerate(key) if char == sep
+        )
+        # Path table built once from the allowed keys: for each parent key, every child key that leads
+        # somewhere maps to its flattened key, whether to keep its value and whether to descend into it.
+        # Keys of the API that are not in it are skipped, the table never grows
+        self.path_table = {parent_key: {} for parent_key in ('',) + tuple(self.nested_keys)}
+        for new_key in self.allowed_keys | self.nested_keys:
+            for parent_key, children in self.path_table.items():
+                prefix = f"{parent_key}{sep}" if parent_key else ''
+                if new_key.startswith(prefix) and len(new_key) > len(prefix):
+                    children[new_key[len(prefix):]] = (new_key, new_key in self.allowed_keys, new_key in self.nested_keys)
+
+    def extract(self, data, parent_key='', extracted=None):
+        if extracted is None:
+            extracted = {}
+        children = self.path_table[parent_key]
+        for key, value in data.items():
+            path = children.get(key)
+            if path is None:
+                continue
+            new_key, is_allowed, is_nested = path
+            if isinstance(value, dict):
+                if is_nested:
+                    self.extract(value, new_key, extracted)
+            elif is_allowed:
+                extracted[new_key] = value
+        return extracted
+
+# Fingerprint of the job content, the keys are sorted so that the
+# same content always gives the same hash
+def content_fingerprint(data):
+    normalized_data = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(normalized_data.encode('utf-8')).hexdigest()
 
 class JobSpider(scrapy.Spider):
     name = 'job_spider'
+    # First url is for featured jobs, the regular jobs are paginated with page_url
     base_url = 'https://careers.fedex.com/api/jobs?page=1&sortBy=relevance&descending=false&featured=true&internal=false&deviceId=undefined&domain=fedex.jibeapply.com'
+    page_url = 'https://careers.fedex.com/api/jobs?page={}&sortBy=relevance&descending=false&internal=false&deviceId=undefined&domain=fedex.jibeapply.com'
 
     custom_settings = {
         'ITEM_PIPELINES': {
@@ -31,170 +81,591 @@ class JobSpider(scrapy.Spider):
     }
 
     allowed_keys = set(JobItem.fields.keys())  # Get the keys defined in JobItem
+    # Compiled once from the JobItem fields, shared by every job of every page
+    field_extractor = FieldExtractor(allowed_keys, sep='_')
+
+    # Number of identifiers read from PostgreSQL and written to the dedup backend at a time when reconciling
+    identifier_chunk_size = 5000
 
     # Initialize common parameters
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, resources=None, dedup=None, coordinator=None, change_feed=None, settings=None, metrics=None, **kwargs):
         super(JobSpider, self).__init__(*args, **kwargs)
         self.log("Starting the spider.")
-        self.page_number = 0
-        
-        # Redis key prefix for storing job_identifier values
-        self.key_prefix_for_identifiers = 'job_identifiers'
 
-        # Redis key prefix for caching
-        self.key_prefix_for_job_cache = 'job_cache'
+        # Connection pools shared with the pipelines, the spider borrows a connection when it needs one
+        self.resources = resources or DatabaseResources()
+        # Settings of the crawl, needed before Scrapy sets them to load the identifiers. They name
+        # the table, the collection and the namespace of the site crawled by this spider
+        self.settings = settings or self.resources.settings
+        # Latencies and counters of this crawl, shared with the pipeline and the managers of the crawler
+        self.metrics = metrics or Metrics()
+        # Known and seen identifiers, fingerprints and page cache (Redis unless DEDUP_BACKEND says otherwise)
+        self.dedup = dedup or RedisDedupBackend(self.resources.redis_manager(metrics=self.metrics))
+        # Events of the jobs added, updated and removed, for the consumers tailing the feed (CHANGE_FEED_BACKEND)
+        self.change_feed = change_feed
+        self.site_name = self.settings.get('SITE_NAME')
 
-        # Initialize Redis client for job identifiers
-        self.redis_identifiers = RedisManager()
+        # Pagination state. The featured jobs are page 0, regular pages start from 1
+        self.serial_pagination = True
+        self.pagination_window = 0
+        self.page_size = None
+        # Number of jobs the API reports on the first page, the sweep checks the crawl against it
+        self.total_count = None
+        self.last_page = 1
+        self.next_page = 1
+        self.pending_pages = set()
+        self.failed_pages = set()
+        # Pages that failed in a row, in serial mode the crawl goes on past a failed page until
+        # max_consecutive_failed_pages of them fail one after the other
+        self.consecutive_failed_pages = 0
+        self.max_consecutive_failed_pages = 3
+        self.crawl_finished = False
+        # The sweep only runs when at least this share of the reported jobs was seen, and refuses to
+        # delete more than this share of the known jobs at once
+        self.sweep_min_completeness = 0.95
+        self.sweep_max_delete_ratio = 0.2
 
-        # Initialize Redis client for job caching
-        self.redis_cache = RedisManager()
+        # With several workers (CRAWL_DISTRIBUTED) the pages are shared out in shards through Redis.
+        # Only the planner of a round loads the identifiers and reads the first pages, the others
+        # wait for shards. shared_last_page is the last page of the round, only the worker crawling
+        # it follows the pages past it
+        self.coordinator = coordinator
+        self.is_planner = True
+        self.shard_active = True
+        self.shared_last_page = None
+        self.poll_interval = 1.0
+        # Looks for a shard every poll_interval seconds while the worker waits for one
+        self.poll_loop = None
+        # Keeps the heartbeat of this worker in the round going, its shard is reassigned when it stops
+        self.heartbeat_loop = None
+        if self.coordinator:
+            self.is_planner = self.coordinator.join()
+            self.log(f"Worker {self.coordinator.worker_id} joined the crawl round as {'planner' if self.is_planner else 'worker'}")
 
-        # Load job_identifiers from database to Redis
-        self.load_identifiers_from_database()
+        # Cleared when a write to the databases fails and the dedup backend may not mirror PostgreSQL anymore
+        self.identifiers_in_sync = True
+
+        # Pages of the last crawls are kept in the dedup backend: the url maps to the ETag and Last-Modified
+        # headers, the hash of the body and the identifiers and fingerprints of the jobs on the page
+        self.page_cache_enabled = True
+
+        # Load job_identifiers from database to the dedup backend
+        if self.is_planner:
+            self.load_identifiers_from_database()
+        else:
+            self.shard_active = False
+            self.last_page = 0
+
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        # The registry of the crawler is created here when the spider is the first to ask for it
+        kwargs['resources'] = DatabaseResources.from_crawler(crawler)
+        kwargs['settings'] = crawler.settings
+        kwargs['metrics'] = Metrics.from_crawler(crawler)
+        kwargs['dedup'] = load_object(crawler.settings.get('DEDUP_BACKEND', 'jobs_project.dedup.RedisDedupBackend')).from_crawler(crawler)
+        if crawler.settings.getbool('CRAWL_DISTRIBUTED', False):
+            if not isinstance(kwargs['dedup'], RedisDedupBackend):
+                raise ValueError("CRAWL_DISTRIBUTED needs the identifiers in Redis, set DEDUP_BACKEND to jobs_project.dedup.RedisDedupBackend")
+            kwargs['coordinator'] = CrawlCoordinator.from_crawler(crawler)
+        if crawler.settings.get('CHANGE_FEED_BACKEND'):
+            change_feed_class = load_object(crawler.settings.get('CHANGE_FEED_BACKEND'))
+            # Every worker would write its own local file, the consumers would only see part of the changes
+            if crawler.settings.getbool('CRAWL_DISTRIBUTED', False) and issubclass(change_feed_class, FileChangeFeed):
+                raise ValueError("CRAWL_DISTRIBUTED needs a shared change feed, set CHANGE_FEED_BACKEND to jobs_project.changes.RedisStreamChangeFeed")
+            kwargs['change_feed'] = change_feed_class.from_crawler(crawler)
+        spider = super(JobSpider, cls).from_crawler(crawler, *args, **kwargs)
+        if spider.coordinator:
+            spider.poll_interval = crawler.settings.getfloat('CRAWL_POLL_INTERVAL', 1.0)
+            crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+            spider.heartbeat_loop = task.LoopingCall(spider.coordinator.heartbeat)
+            spider.heartbeat_loop.start(max(spider.coordinator.lease_timeout / 3, 1), now=False)
+        return spider
 
-    
     def start_requests(self):
-        url = self.base_url
-        # First url was for featured jobs, now change it to get the regular jobs
-        self.base_url = 'https://careers.fedex.com/api/jobs?page={}&sortBy=relevance&descending=false&internal=false&deviceId=undefined&domain=fedex.jibeapply.com'
-        yield scrapy.Request(url=url, callback=self.parse_json_response)
+        # In 'concurrent' mode the number of pages is read from the first regular page and the
+        # remaining pages are requested at once (or PAGINATION_WINDOW at a time).
+        # In 'serial' mode each page is requested after the previous one has been parsed
+        self.serial_pagination = self.settings.get('PAGINATION_MODE', 'concurrent') == 'serial'
+        self.pagination_window = self.settings.getint('PAGINATION_WINDOW', 0)
+        self.page_cache_enabled = self.settings.getbool('PAGE_CACHE_ENABLED', True)
+        self.sweep_min_completeness = self.settings.getfloat('SWEEP_MIN_COMPLETENESS', self.sweep_min_completeness)
+        self.sweep_max_delete_ratio = self.settings.getfloat('SWEEP_MAX_DELETE_RATIO', self.sweep_max_delete_ratio)
+        if not self.is_planner:
+            # The pages come from the shards of the planner
+            return
+
+        cached_pages = self.cached_pages([self.base_url])
+        yield self.page_request(self.base_url, page=0, cached_page=cached_pages.get(self.base_url))
+        yield from self.schedule_pages()
+
+    def page_request(self, url, page, cached_page=None, dont_filter=False):
+        self.pending_pages.add(page)
+        meta = {'page': page}
+        headers = {}
+        if cached_page:
+            # Conditional request, the API answers 304 without a body when the page has not changed
+            meta['cached_page'] = cached_page
+            meta['handle_httpstatus_list'] = [304]
+            if cached_page.get('etag'):
+                headers['If-None-Match'] = cached_page['etag']
+            if cached_page.get('last_modified'):
+                headers['If-Modified-Since'] = cached_page['last_modified']
+        return scrapy.Request(url=url, callback=self.parse_json_response, errback=self.page_failed,
+                              headers=headers, meta=meta, dont_filter=dont_filter)
+
+    def schedule_pages(self):
+        # Request the pages up to last_page, keeping at most pagination_window pages in flight
+        pages = []
+        while self.next_page <= self.last_page:
+            if self.pagination_window and len(self.pending_pages) + len(pages) >= self.pagination_window:
+                break
+            pages.append(self.next_page)
+            self.next_page += 1
+        # The cache entries of all the scheduled pages are read in one round-trip
+        urls = [self.page_url.format(page) for page in pages]
+        cached_pages = self.cached_pages(urls)
+        for page, url in zip(pages, urls):
+            yield self.page_request(url, page=page, cached_page=cached_pages.get(url))
+
+    def cached_pages(self, urls):
+        if not self.page_cache_enabled or not urls:
+            return {}
+        return {url: json.loads(value) for url, value in self.dedup.get_cached_pages(urls).items()}
+
+    def cache_page(self, response, total_count, job_count, page_fingerprints):
+        if not self.page_cache_enabled:
+            return
+        cached_page = {
+            'etag': response.headers.get('ETag', b'').decode('latin-1') or None,
+            'last_modified': response.headers.get('Last-Modified', b'').decode('latin-1') or None,
+            'body_hash': hashlib.sha1(response.body).hexdigest(),
+            'total_count': total_count,
+            'job_count': job_count,
+            'jobs': page_fingerprints,
+        }
+        self.dedup.cache_page(response.url, json.dumps(cached_page))
+
+    def mark_cached_page_seen(self, cached_page):
+        # The jobs of an unchanged page are marked as active in bulk. The page is only trusted
+        # when every job on it is stored with the fingerprint it had when the page was cached
+        identifiers = list(cached_page['jobs'])
+        stored_fingerprints = self.dedup.mark_seen(identifiers)
+        return all(stored_fingerprint == cached_page['jobs'][identifier]
+                   for identifier, stored_fingerprint in zip(identifiers, stored_fingerprints))
 
     def parse_json_response(self, response):
+        page = response.meta.get('page', 0)
+        # Time between sending the request and receiving the response headers, measured by Scrapy
+        if 'download_latency' in response.meta:
+            self.metrics.observe('http_fetch_seconds', response.meta['download_latency'])
+
+        # An unchanged page (304, or the same body when the API sends no validators) is not decoded
+        cached_page = response.meta.get('cached_page')
+        if cached_page:
+            unchanged = response.status == 304 or hashlib.sha1(response.body).hexdigest() == cached_page['body_hash']
+            if unchanged and self.mark_cached_page_seen(cached_page):
+                self.metrics.increment('pages_unchanged')
+                self.metrics.increment('jobs_seen', len(cached_page['jobs']))
+                yield from self.page_done(page, cached_page['total_count'], cached_page['job_count'])
+                return
+            if response.status == 304:
+                # The stored jobs do not match the cached page anymore, fetch the whole page again
+                yield self.page_request(response.url, page, dont_filter=True)
+                return
+
         try:
-            job_data = json.loads(response.text)
+            with self.metrics.timer('json_decode_seconds'):
+                # orjson reads the raw bytes, there is no need to decode the body to a string first
+                job_data = orjson.loads(response.body) if orjson else json.loads(response.text)
             jobs = job_data.get('jobs', [])
-            # if there are no jobs, that means scraping is done. First delete all the inactive jobs 
-            # from databases and then stop the spider
-            if not jobs:
-                self.delete_inactive_jobs_from_databases()
-                self.log("No more data to scrape. Stopping the spider.")
-                return
-            
-            for job in jobs: 
-                req_id = job.get('data', {}).get('req_id')
-                title = job.get('data', {}).get('title')
-                street_address = job.get('data', {}).get('street_address')
-                # Concatenate title and street_address to create a unique identifier
-                identifier = f"{req_id}_{title}_{street_address}"
-                
-                # Since the job is still on the website , mark it as active by setting its value to true
-                self.redis_identifiers.set_value_for_an_existing_key(self.key_prefix_for_identifiers, identifier,'true')
-            
-                # Item is neither in the cache nor in the database , so forward it to the storing phase
-                if not (self.is_item_cached(identifier) or self.is_item_in_the_database(identifier)):
-                    item = JobItem()
-                    flattened_data = flatten_dict(job["data"], parent_key='', sep='_')
-                    filtered_data = {key: flattened_data[key] for key in flattened_data if key in self.allowed_keys}
-                    filtered_data["job_identifier"] = identifier
-                    item.update(filtered_data)
-                    yield item
-                    self.cache_item(identifier)
         except json.JSONDecodeError:
             self.log(f"Failed to decode JSON from response: {response.url}")
+            # A truncated or error page, fetch it again after a backoff while retries are left
+            retry_request = get_retry_request(response.request, spider=self, reason='invalid_json',
+                                              max_retry_times=self.settings.getint('API_RETRY_TIMES', 5))
+            if retry_request is not None:
+                yield retry_request
+            else:
+                yield from self.page_failed(response.request)
+            return
+
+        identifiers = [self.job_identifier(job) for job in jobs]
+
+        # Since the jobs are still on the website , mark them as active by adding them to the seen set.
+        # In the same round-trip get the fingerprints of the stored ones
+        stored_fingerprints = self.dedup.mark_seen(identifiers)
+
+        new_identifiers = []
+        fingerprints = {}
+        page_fingerprints = {}
+        changes = []
+        for job, identifier, stored_fingerprint in zip(jobs, identifiers, stored_fingerprints):
+            if identifier in page_fingerprints:
+                continue
+            fingerprint = content_fingerprint(job["data"])
+            page_fingerprints[identifier] = fingerprint
+            if stored_fingerprint is None:
+                # Item is not in the database , so forward it to the storing phase. A job the sweep
+                # deleted has no fingerprint anymore and is stored again when it is reposted
+                new_identifiers.append(identifier)
+            elif stored_fingerprint == fingerprint:
+                # Item is in the database and has not changed
+                continue
+            # New and changed items are stored, the pipeline overwrites the stored version of a changed one
+            fingerprints[identifier] = fingerprint
+            changes.append(change_event(ADDED if stored_fingerprint is None else UPDATED, identifier, fingerprint, self.site_name))
+            # The extractor fills the slots of the record, no intermediate dictionary
+            with self.metrics.timer('job_flatten_seconds'):
+                item = self.field_extractor.extract(job["data"], extracted=JobRecord())
+            item.job_identifier = identifier
+            item.content_hash = fingerprint
+            yield item
+        # The changes of a page are published together, in the order of the page
+        self.publish_changes(changes)
+        # Stored jobs are known from now on, the next crawl can skip the reload from PostgreSQL
+        self.dedup.add_stored(new_identifiers, fingerprints)
+        self.metrics.increment('jobs_seen', len(jobs))
+        self.metrics.increment('jobs_stored', len(fingerprints))
+        total_count = job_data.get('totalCount')
+        self.cache_page(response, total_count, len(jobs), page_fingerprints)
+
+        yield from self.page_done(page, total_count, len(jobs))
+
+    def page_done(self, page, total_count, job_count):
+        self.pending_pages.discard(page)
+        self.consecutive_failed_pages = 0
+
+        if page == 1:
+            self.page_size = job_count
+            self.total_count = total_count
+            # Without the total count fall back to following the pages one by one
+            if not self.serial_pagination and total_count and self.page_size:
+                self.last_page = max(math.ceil(total_count / self.page_size), 1)
+            else:
+                self.serial_pagination = True
+            if self.coordinator:
+                self.share_pages()
+
+        # Keep following the pages while the last known page is not empty. In concurrent mode
+        # this only happens when more jobs were posted than the first page reported
+        if page and page == self.last_page and job_count and (self.shared_last_page is None or page >= self.shared_last_page):
+            if self.serial_pagination or job_count >= self.page_size:
+                self.last_page += 1
+
+        yield from self.schedule_pages()
+        self.finish_crawl_if_done()
+
+    def page_failed(self, failure_or_request):
+        request = getattr(failure_or_request, 'request', failure_or_request)
+        page = request.meta.get('page', 0)
+        self.log(f"Failed to fetch page {page}: {request.url}")
+        self.failed_pages.add(page)
+        self.pending_pages.discard(page)
+
+        if page:
+            self.consecutive_failed_pages += 1
+            # Without the first page the number of pages is unknown, follow the pages one by one
+            if page == 1 and self.page_size is None:
+                self.serial_pagination = True
+                if self.coordinator:
+                    self.share_pages()
+            # A failed page is not the end of the jobs, keep following the pages after it
+            if self.serial_pagination and page == self.last_page and self.consecutive_failed_pages < self.max_consecutive_failed_pages:
+                self.last_page += 1
+
+        yield from self.schedule_pages()
+        self.finish_crawl_if_done()
+
+    def share_pages(self):
+        # In serial mode the number of pages is unknown, the planner follows them on its own
+        if self.serial_pagination:
+            self.coordinator.plan(2, 1, self.page_size, self.total_count)
+            return
+        shard_count = self.coordinator.plan(2, self.last_page, self.page_size, self.total_count)
+        self.log(f"Shared pages 2 to {self.last_page} in {shard_count} shards")
+        self.shared_last_page = self.last_page
+        self.last_page = 1
+
+    def take_shard(self):
+        shard = self.coordinator.next_shard()
+        if shard is None:
+            return False
+        first_page, last_page, round_info = shard
+        self.log(f"Crawling pages {first_page} to {last_page}")
+        self.serial_pagination = False
+        self.page_size = int(round_info.get('page_size', 0)) or None
+        self.total_count = int(round_info.get('total_count', 0)) or None
+        self.shared_last_page = int(round_info.get('last_page', last_page))
+        self.next_page = first_page
+        self.last_page = last_page
+        self.shard_active = True
+        for request in self.schedule_pages():
+            self.crawler.engine.crawl(request)
+        return True
+
+    def spider_idle(self):
+        if self.take_shard():
+            raise DontCloseSpider
+        if self.coordinator.is_waiting():
+            # The planner has not shared the pages yet, or shards of other workers may come back, look again shortly
+            if self.poll_loop is None or not self.poll_loop.running:
+                self.poll_loop = task.LoopingCall(self.poll_shards)
+                self.poll_loop.start(self.poll_interval, now=False)
+            raise DontCloseSpider
 
-        # Follow the next page
-        self.page_number += 1
-        next_page_url = self.base_url.format(self.page_number)
-        yield scrapy.Request(url=next_page_url, callback=self.parse_json_response)
+    def poll_shards(self):
+        # Stops once a shard is taken, or once there is nothing left to wait for and the spider can close
+        if self.take_shard():
+            self.poll_loop.stop()
+        elif not self.coordinator.is_waiting():
+            self.poll_loop.stop()
+            self.crawler.engine.close_spider(self, 'finished')
+
+    def finish_shard(self):
+        if not self.shard_active:
+            return
+        self.shard_active = False
+        if self.coordinator.shard_done(self.failed_pages):
+            # Every shard of the round is done, this worker sweeps the closed jobs for all of them
+            self.crawl_finished = True
+            self.log("Last shard of the crawl round done, running the sweep")
+            if self.crawl_is_complete():
+                self.delete_inactive_jobs_from_databases()
+
+    def finish_crawl_if_done(self):
+        if self.crawl_finished or self.pending_pages or self.next_page <= self.last_page:
+            return
+        if self.coordinator:
+            self.finish_shard()
+            return
+        self.crawl_finished = True
+
+        # Mark phase is over: every job on the website is in the seen set. The sweep deletes the
+        # others, but only when the crawl is complete enough to trust that they are really closed
+        if self.crawl_is_complete():
+            self.delete_inactive_jobs_from_databases()
+        self.log("No more data to scrape. Stopping the spider.")
+
+    def crawl_is_complete(self):
+        stats = self.crawler.stats
+        # A failed page means some active jobs were never seen, so they must not be deleted
+        failed_pages = self.coordinator.failed_pages() if self.coordinator else self.failed_pages
+        if failed_pages:
+            self.log(f"Skipping the deletion of inactive jobs, failed pages: {sorted(failed_pages)}")
+            stats.set_value('sweep/status', 'skipped_failed_pages')
+            return False
+
+        # Pages that came back shorter than announced (an API hiccup, a truncated listing) are
+        # caught by comparing the jobs seen with the total count of the first page
+        seen_count = self.dedup.seen_count()
+        stats.set_value('sweep/seen_jobs', seen_count)
+        if self.total_count:
+            stats.set_value('sweep/expected_jobs', self.total_count)
+            if seen_count < self.total_count * self.sweep_min_completeness:
+                self.log(f"Skipping the deletion of inactive jobs, only {seen_count} of {self.total_count} jobs were seen")
+                stats.set_value('sweep/status', 'skipped_incomplete')
+                return False
+        return True
     
+    def job_identifier(self, job):
+        req_id = job.get('data', {}).get('req_id')
+        title = job.get('data', {}).get('title')
+        street_address = job.get('data', {}).get('street_address')
+        # Concatenate title and street_address to create a unique identifier
+        return f"{req_id}_{title}_{street_address}"
+
     def load_identifiers_from_database(self):
-        postgres_manager = PostgreSQLManager()
+        # Nothing has been seen yet in this crawl
+        self.dedup.start_crawl()
+
+        postgres_manager = self.resources.postgresql_manager(self.settings, metrics=self.metrics)
+        if not postgres_manager.ensure_connection():
+            # The identifiers held by the backend are kept, they are reconciled once PostgreSQL is back
+            self.log("PostgreSQL is unreachable, the job identifiers are not reloaded")
+            self.identifiers_in_sync = False
+            self.dedup.clear_generation()
+            return
     
         # First check whether the table exists or not
         try:
-            postgres_manager.execute_query("select * from information_schema.tables where table_name=%s", (os.getenv('POSTGRES_TABLE_NAME'),))
+            postgres_manager.execute_query("select * from information_schema.tables where table_name=%s", (postgres_manager.table_name,))
             table_exists = bool(postgres_manager.cursor.rowcount)
         except:
             table_exists =  False    
         if table_exists:
-            
-            select_identifiers_query = """
-                SELECT job_identifier FROM {table_name}
-            """.format(table_name=os.getenv('POSTGRES_TABLE_NAME'))
-            
             try:
-                # Retrieve job_identifiers rows from PostgreSQL
-                data = postgres_manager.fetch_values(select_identifiers_query)
-                postgres_manager.close_connection()
-                identifiers = [row[0] for row in data]
-                
-                # Store identifiers in Redis set with initial value 'false' and key prefix
-                for identifier in identifiers:
-                    redis_key = f"{self.key_prefix_for_identifiers}:{identifier}"
-                    self.redis_identifiers.set_value(redis_key, 'false')
+                # Tables created before content fingerprints and generations were introduced
+                postgres_manager.add_column_if_not_exists('content_hash', 'TEXT')
+                postgres_manager.create_generation_counter()
+
+                # The dedup backend still holds the identifiers of the table when the table has not changed
+                # since the last crawl that ended cleanly, then there is nothing to load
+                generation = postgres_manager.fetch_generation()
+                if generation and self.dedup.get_generation() == generation:
+                    self.log(f"Job identifiers are up to date with PostgreSQL (generation {generation})")
+                else:
+                    self.reconcile_identifiers(postgres_manager)
             except psycopg2.Error as e:
                 self.log(f"Failed to retrieve job identifiers from PostgreSQL. Error: {e}")
+        else:
+            # Nothing is stored yet, forget the identifiers of any previous database
+            self.dedup.clear()
+        postgres_manager.close_connection()
 
+        # The backend changes during the crawl, the generation is written again when the crawl ends cleanly
+        self.dedup.clear_generation()
 
-        
-    def is_item_in_the_database(self,identifier):
-        # check if the item already in the redis structure for job_identifiers
-        redis_key = f"{self.key_prefix_for_identifiers}:{identifier}"
-        return self.redis_identifiers.exists(redis_key)
-        
-    def is_item_cached(self, identifier):
-        # Check if the identifier is present in Redis cache for job postings
-        cache_key = f"{self.key_prefix_for_job_cache}:{identifier}"
-        return self.redis_cache.exists(cache_key)
-    
-    def cache_item(self, identifier):
-        # Cache the identifier in Redis cache for job postings
-        cache_key = f"{self.key_prefix_for_job_cache}:{identifier}"
-        self.redis_cache.set_value(cache_key, 1)
+    def reconcile_identifiers(self, postgres_manager):
+        # The identifiers are streamed from PostgreSQL chunk by chunk, and the backend only
+        # writes the fingerprints that differ from the ones it holds
+        select_identifiers_query = """
+            SELECT job_identifier, content_hash FROM {table_name}
+        """.format(table_name=postgres_manager.table_name)
+
+        # Rows stored before fingerprints were introduced have none, they are stored again once
+        chunks = (
+            {identifier: fingerprint or '' for identifier, fingerprint in rows}
+            for rows in self.with_heartbeat(postgres_manager.stream_values(select_identifiers_query, self.identifier_chunk_size))
+        )
+        identifiers_count, written_count, deleted_count = self.dedup.reconcile(chunks)
+        self.log(f"Reconciled {identifiers_count} job identifiers with PostgreSQL: "
+                 f"{written_count} fingerprints written, {deleted_count} removed")
+
+    def with_heartbeat(self, chunks):
+        # The reactor is blocked while a large table is loaded, the planner keeps its heartbeat going
+        # by hand so the other workers do not take the round for abandoned
+        for chunk in chunks:
+            if self.coordinator:
+                self.coordinator.heartbeat()
+            yield chunk
+
+    def closed(self, reason):
+        if self.coordinator:
+            self.leave_round(reason)
+        else:
+            self.save_generation(reason)
+        self.dedup.close()
+        if self.change_feed:
+            self.change_feed.close()
+
+    def leave_round(self, reason):
+        if self.poll_loop is not None and self.poll_loop.running:
+            self.poll_loop.stop()
+        if self.heartbeat_loop is not None and self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+        if not self.crawl_is_clean(reason):
+            self.coordinator.mark_dirty()
+        # The last worker to leave has seen every other worker write its items
+        if self.coordinator.leave():
+            # Tells the scheduler of this worker to run the export of the round
+            self.crawler.stats.set_value('crawl_round/last_worker', True)
+            if self.coordinator.is_complete() and not self.coordinator.is_dirty():
+                self.save_generation(reason)
+            else:
+                self.log("Job identifiers will be reloaded on the next crawl, the crawl round did not end cleanly")
+            self.coordinator.finish_round()
+
+    def crawl_is_clean(self, reason):
+        # The backend mirrors PostgreSQL only when the crawl ended normally and every write made it to the table
+        failed_rows = self.crawler.stats.get_value('pipeline/postgresql_failed_rows', 0)
+        # Items that could not be appended to the spool are known to the backend but lost, the reload
+        # forgets them and the next crawl yields them again
+        failed_rows += self.crawler.stats.get_value('pipeline/spool_failed_rows', 0)
+        # Items still in the spool are known to the backend but not in the table yet
+        spool_backlog = self.crawler.stats.get_value('spool/postgresql_backlog_bytes', 0)
+        if reason != 'finished' or failed_rows or spool_backlog or not self.identifiers_in_sync:
+            self.log(f"Job identifiers will be reloaded on the next crawl (reason: {reason}, failed rows: {failed_rows}, "
+                     f"spool backlog: {spool_backlog} bytes)")
+            return False
+        return True
+
+    def save_generation(self, reason):
+        if not self.crawl_is_clean(reason):
+            return
+
+        postgres_manager = self.resources.postgresql_manager(self.settings, metrics=self.metrics)
+        try:
+            generation = postgres_manager.fetch_generation()
+        except psycopg2.Error as e:
+            self.log(f"Failed to read the table generation from PostgreSQL. Error: {e}")
+            generation = None
+        postgres_manager.close_connection()
+        if generation:
+            self.dedup.set_generation(generation)
 
     def delete_inactive_jobs_from_databases(self):
-        # Get all keys from Redis identifiers set where the value is 'false'
-        false_identifiers = self.redis_identifiers.get_keys_with_value_and_prefix(self.key_prefix_for_identifiers, 'false')
-        # Delete job_identifier elements from Redis based on keys in false_identifiers
-        for identifier in false_identifiers:
-            key_to_delete = f"{self.key_prefix_for_identifiers}:{identifier}"
-            self.redis_identifiers.delete(key_to_delete)
-        
-        # Delete items from PostgreSQL
-        self.delete_inactive_jobs_from_postgresql(false_identifiers)
+        stats = self.crawler.stats
+        start_time = time.monotonic()
+        # Inactive jobs are the known identifiers that were not seen during this crawl
+        false_identifiers = self.dedup.inactive_identifiers()
+        known_count = self.dedup.known_count()
+        stats.set_value('sweep/known_jobs', known_count)
+        stats.set_value('sweep/inactive_jobs', len(false_identifiers))
+
+        # Far more closed jobs than usual points to a broken listing rather than closed jobs,
+        # they are kept and swept by a later crawl if they are still missing then
+        if known_count and len(false_identifiers) > known_count * self.sweep_max_delete_ratio:
+            self.log(f"Refusing to delete {len(false_identifiers)} of {known_count} known jobs, "
+                     f"more than SWEEP_MAX_DELETE_RATIO={self.sweep_max_delete_ratio}")
+            stats.set_value('sweep/status', 'refused')
+            return
 
-        # Delete items from MongoDB
-        self.delete_inactive_jobs_from_mongodb(false_identifiers)
+        # Delete the inactive identifiers from the known ones and their fingerprints
+        self.dedup.forget(false_identifiers)
         
-        print(f"Number of deleted closed job postings: {len(false_identifiers)}")
-        print(f"Deleted job postings: {false_identifiers}")
+        # Delete items from PostgreSQL, one statement for all of them
+        stats.set_value('sweep/deleted/postgresql', self.delete_inactive_jobs_from_postgresql(false_identifiers))
+
+        # Delete items from MongoDB, one delete_many for all of them
+        stats.set_value('sweep/deleted/mongodb', self.delete_inactive_jobs_from_mongodb(false_identifiers))
+
+        self.publish_changes([change_event(REMOVED, identifier, site=self.site_name) for identifier in false_identifiers])
+
+        stats.set_value('sweep/status', 'done')
+        stats.set_value('sweep/seconds', time.monotonic() - start_time)
+        self.metrics.increment('jobs_deleted', len(false_identifiers))
+        self.logger.info(f"Deleted {len(false_identifiers)} closed job postings")
         
         
+    def publish_changes(self, changes):
+        if not self.change_feed or not changes:
+            return
+        self.change_feed.publish(changes)
+        for change in changes:
+            self.crawler.stats.inc_value(f"change_feed/{change['type']}")
+
     def delete_inactive_jobs_from_postgresql(self, false_identifiers):
         # Check if there are any false identifiers
         if not false_identifiers:
-            return
+            return 0
 
         # Connect to postgres
-        postgres_manager = PostgreSQLManager()
-        
-        # Create a SQL query to delete items with false identifiers
-        delete_query = """
-            DELETE FROM raw_table
-            WHERE job_identifier = ANY(%s)
-        """
+        postgres_manager = self.resources.postgresql_manager(self.settings, metrics=self.metrics)
         
-        # Execute the query
-        postgres_manager.execute_query(delete_query, (false_identifiers,))
+        # Delete items with false identifiers, an index lookup thanks to the unique index on job_identifier
+        deleted_count = 0
+        if postgres_manager.delete_rows_with_identifiers(false_identifiers):
+            deleted_count = postgres_manager.cursor.rowcount
+        else:
+            self.identifiers_in_sync = False
         
         # Close database connection
         postgres_manager.close_connection()
+        return deleted_count
         
         
     def delete_inactive_jobs_from_mongodb(self, false_identifiers):
         # Check if there are any false identifiers
         if not false_identifiers:
-            return
+            return 0
 
         # Connect to MongoDB
-        mongo_manager = MongoDBManager()
-
-        # Create a filter to match items with false identifiers
-        filter_query = {'job_identifier': {'$in': false_identifiers}}
+        mongo_manager = self.resources.mongodb_manager(self.settings, metrics=self.metrics)
 
-        # Delete items from MongoDB
-        mongo_manager.mongo_collection.delete_many(filter_query)
+        # Delete items with false identifiers from MongoDB
+        deleted_count = mongo_manager.delete_documents_with_identifiers(false_identifiers)
         
         # Close database connection
-        mongo_manager.close_connection()
\ No newline at end of file
+        mongo_manager.close_connection()
+        return deleted_count or 0
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""Write-ahead spool of the pipeline.
+
+The pipeline appends every job to a local append-only log before any database sees it, and a
+drainer per store replays the log into that store in bulk. Every store keeps its own offset, so
+a store that is down only falls behind and catches up once it is back, without holding up the
+crawl or the other store.
+
+The log is a directory of segments, files of JSON lines named after their number, and one
+offset file per store holding 'segment position'. Appends are flushed to the file at once and
+fsynced at most every fsync_interval seconds. A segment is deleted once every store has read
+past it. Distributed workers (CRAWL_DISTRIBUTED) sharing SPOOL_DIR each have their own spool in
+a directory named after the worker, a spool is only ever written and drained by one process.
+"""
+import json
+import os
+import threading
+import time
+
+SEGMENT_SUFFIX = '.jsonl'
+
+
+class Spool:
+    def __init__(self, directory, consumers, segment_size=64 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.consumers = tuple(consumers)
+        # A new segment is started once the current one holds segment_size bytes
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.last_sync_time = time.monotonic()
+        # Appends come from the reactor, reads and commits from the drainer threads
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.directory, 'offsets'), exist_ok=True)
+
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        self.truncate_partial_line()
+
+    @classmethod
+    def from_crawler(cls, crawler, consumers):
+        settings = crawler.settings
+        directory = settings.get('SPOOL_DIR', 'spool')
+        # Every site of a multi-site run has its own spool
+        site_name = settings.get('SITE_NAME')
+        if site_name:
+            directory = os.path.join(directory, site_name)
+        if settings.getbool('CRAWL_DISTRIBUTED', False):
+            from jobs_project.coordinator import default_worker_id
+
+            # Set CRAWL_WORKER_ID to find the spool of a worker again after it restarts
+            worker_id = settings.get('CRAWL_WORKER_ID') or default_worker_id()
+            directory = os.path.join(directory, 'workers', worker_id.replace(os.sep, '_'))
+        return cls(
+            directory,
+            consumers,
+            segment_size=settings.getint('SPOOL_SEGMENT_SIZE', 64 * 1024 * 1024),
+            fsync_interval=settings.getfloat('SPOOL_FSYNC_INTERVAL', 1.0),
+        )
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def offset_path(self, consumer):
+        return os.path.join(self.directory, 'offsets', consumer)
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def truncate_partial_line(self):
+        # A crash in the middle of an append leaves half a line at the end of the last segment
+        self.segment_file.seek(0, os.SEEK_END)
+        size = self.segment_file.tell()
+        if not size:
+            return
+        # The end of the last whole line, looked for backwards a chunk at a time
+        end = size
+        with open(self.segment_path(self.segment), 'rb') as segment_file:
+            while end > 0:
+                start = max(end - 65536, 0)
+                segment_file.seek(start)
+                newline = segment_file.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+        if end < size:
+            self.segment_file.truncate(end)
+            self.segment_file.seek(0, os.SEEK_END)
+
+    def append(self, documents):
+        # One JSON line per document, one write and one flush for all of them
+        data = b''.join(json.dumps(document, ensure_ascii=False, default=str).encode('utf-8') + b'\n' for document in documents)
+        with self.lock:
+            self.segment_file.write(data)
+            self.segment_file.flush()
+            if time.monotonic() - self.last_sync_time >= self.fsync_interval:
+                self.sync()
+            if self.segment_file.tell() >= self.segment_size:
+                self.sync()
+                self.segment_file.close()
+                self.segment += 1
+                self.segment_file = open(self.segment_path(self.segment), 'ab')
+
+    def sync(self):
+        os.fsync(self.segment_file.fileno())
+        self.last_sync_time = time.monotonic()
+
+    def get_offset(self, consumer):
+        try:
+            with open(self.offset_path(consumer)) as offset_file:
+                segment, position = offset_file.read().split()
+            return int(segment), int(position)
+        except (FileNotFoundError, ValueError):
+            # A new consumer starts with the oldest segment left
+            segments = self.segments()
+            return (segments[0] if segments else 0), 0
+
+    def read(self, consumer, max_documents):
+        # Returns (documents, offset after them) from the offset of the consumer on
+        segment, position = self.get_offset(consumer)
+        documents = []
+        with self.lock:
+            last_segment = self.segment
+        while len(documents) < max_documents:
+            try:
+                with open(self.segment_path(segment), 'rb') as segment_file:
+                    segment_file.seek(position)
+                    for line in segment_file:
+                        # Only whole lines, the rest of a line being appended is read next time
+                        if not line.endswith(b'\n'):
+                            break
+                        documents.append(json.loads(line))
+                        position += len(line)
+                        if len(documents) >= max_documents:
+                            break
+            except FileNotFoundError:
+                pass
+            if len(documents) >= max_documents or segment >= last_segment:
+                break
+            # The segment is read to its end and the writer has moved on to a newer one
+            segment, position = segment + 1, 0
+        return documents, (segment, position)
+
+    def commit(self, consumer, offset):
+        # The offset file is replaced in one step, a crash leaves either the old or the new offset
+        offset_path = self.offset_path(consumer)
+        with open(f"{offset_path}.tmp", 'w') as offset_file:
+            offset_file.write(f"{offset[0]} {offset[1]}")
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(f"{offset_path}.tmp", offset_path)
+        self.remove_consumed_segments()
+
+    def remove_consumed_segments(self):
+        oldest_segment = min(self.get_offset(consumer)[0] for consumer in self.consumers)
+        with self.lock:
+            for segment in self.segments():
+                if segment >= min(oldest_segment, self.segment):
+                    break
+                os.remove(self.segment_path(segment))
+
+    def backlog(self, consumer):
+        # Bytes appended that the consumer has not read yet
+        segment, position = self.get_offset(consumer)
+        backlog = -position
+        for other_segment in self.segments():
+            if other_segment >= segment:
+                backlog += os.path.getsize(self.segment_path(other_segment))
+        return max(backlog, 0)
+
+    def close(self):
+        with self.lock:
+            self.segment_file.flush()
+            self.sync()
+            self.segment_file.close()
@@ -1,11 +1,204 @@
 import psycopg2
 import csv
+import json
+import argparse
+from bson import ObjectId
 from pymongo import MongoClient
 import os
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # pyarrow is only needed for the parquet export format
+    pyarrow = None
+
+def arrow_type(data_type, udt_name):
+    # Map a PostgreSQL column type from information_schema to an Arrow type, anything unknown is kept as a string
+    if data_type == 'ARRAY':
+        return pyarrow.list_(arrow_type(udt_name.lstrip('_'), None))
+    return {
+        'smallint': pyarrow.int16(),
+        'int2': pyarrow.int16(),
+        'integer': pyarrow.int32(),
+        'int4': pyarrow.int32(),
+        'bigint': pyarrow.int64(),
+        'int8': pyarrow.int64(),
+        'real': pyarrow.float32(),
+        'float4': pyarrow.float32(),
+        'double precision': pyarrow.float64(),
+        'float8': pyarrow.float64(),
+        'boolean': pyarrow.bool_(),
+        'bool': pyarrow.bool_(),
+        'timestamp without time zone': pyarrow.timestamp('us'),
+        'timestamp': pyarrow.timestamp('us'),
+    }.get(data_type, pyarrow.string())
+
+def as_text(value):
+    return value if value is None or isinstance(value, str) else str(value)
+
+def read_csv_header(filename):
+    # The first row of a CSV file, None when there is no file or it is empty
+    if not os.path.exists(filename):
+        return None
+    with open(filename, newline='') as csv_file:
+        return next(csv.reader(csv_file), None)
+
+class CsvExportWriter:
+    extension = 'csv'
+
+    def __init__(self, filename, headers, column_types=None, append=False):
+        self.filename = f"{filename}.{self.extension}"
+        # Clear existing file if it exists, a change log is only appended to and gets its header once
+        if not append and os.path.exists(self.filename):
+            os.remove(self.filename)
+        # A change log written with other columns (an older version of the table) is moved aside,
+        # the rows appended from now on go to a new file under the new header
+        if append and read_csv_header(self.filename) not in (None, list(headers)):
+            rotated_filename = f"{filename}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{self.extension}"
+            os.replace(self.filename, rotated_filename)
+            print(f"The columns of {self.filename} changed, the previous change log was moved to {rotated_filename}")
+        write_header = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+        self.file = open(self.filename, 'a', newline='')
+        self.csv_writer = csv.writer(self.file)
+        if write_header:
+            self.csv_writer.writerow(headers)
+
+    def write_rows(self, rows):
+        # Rows are written as they arrive, so memory use does not depend on the table size
+        self.csv_writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class ParquetExportWriter:
+    extension = 'parquet'
+
+    def __init__(self, filename, headers, column_types=None, append=False, row_group_size=10000):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for the parquet export format")
+        # Parquet files can not be appended to, so every run of a change log gets its own file
+        if append:
+            filename = f"{filename}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        self.filename = f"{filename}.{self.extension}"
+        self.headers = headers
+        column_types = column_types or {}
+        self.schema = pyarrow.schema([
+            (column, arrow_type(*column_types[column]) if column in column_types else pyarrow.string())
+            for column in headers
+        ])
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema, compression='zstd')
+
+    def write_rows(self, rows):
+        # Rows are buffered and written one row group at a time
+        for row in rows:
+            self.rows.append(row)
+            if len(self.rows) >= self.row_group_size:
+                self.write_row_group()
+
+    def write_row_group(self):
+        if not self.rows:
+            return
+        columns = {}
+        for index, field in enumerate(self.schema):
+            values = [row[index] for row in self.rows]
+            if field.type == pyarrow.string():
+                # Values like the MongoDB ObjectId are written as text
+                values = [as_text(value) for value in values]
+            elif field.type == pyarrow.list_(pyarrow.string()):
+                values = [None if value is None else [as_text(element) for element in value] for value in values]
+            columns[field.name] = values
+        self.parquet_writer.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.write_row_group()
+        self.parquet_writer.close()
+
+EXPORT_WRITERS = {
+    'csv': CsvExportWriter,
+    'parquet': ParquetExportWriter,
+}
+
+def export_rows(export_format, filename, headers, rows, column_types=None, append=False):
+    # Write the rows with the writer of the requested format, returns the name of the written file
+    writer = EXPORT_WRITERS[export_format](filename, headers, column_types, append)
+    try:
+        writer.write_rows(rows)
+    finally:
+        writer.close()
+    return writer.filename
+
+def load_export_state(state_filename):
+    if not os.path.exists(state_filename):
+        return {}
+    with open(state_filename) as state_file:
+        return json.load(state_file)
+
+def save_export_state(state_filename, state):
+    # Write to a temporary file first so an interrupted run never leaves a broken state file
+    temporary_filename = f"{state_filename}.tmp"
+    with open(temporary_filename, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_filename, state_filename)
+
+def exported_fingerprints(store_state):
+    # job_identifier -> content_hash of the jobs of the last export. Older state files only have the list of identifiers
+    previous_fingerprints = store_state.get('identifiers', {})
+    if isinstance(previous_fingerprints, list):
+        previous_fingerprints = dict.fromkeys(previous_fingerprints)
+    return previous_fingerprints
+
+def added_rows(headers, rows, store_state, id_column, added_identifiers):
+    # Yield the new rows, keeping track of the high-water mark when id_column is given. A row
+    # already in the last export was found by its fingerprint then and is not added twice
+    id_index = headers.index(id_column) if id_column else None
+    identifier_index = headers.index('job_identifier')
+    previous_fingerprints = exported_fingerprints(store_state)
+    for row in rows:
+        if id_index is not None:
+            store_state['last_id'] = row[id_index]
+        if row[identifier_index] in previous_fingerprints:
+            continue
+        added_identifiers.add(row[identifier_index])
+        yield ['added'] + list(row)
+
+def compare_fingerprints(store_state, current_fingerprints, added_identifiers):
+    # Updated jobs keep their id, so they are found by comparing the content_hash of every job
+    # with the one of the last export. The same comparison finds the jobs added below the
+    # high-water mark: a row that committed after a row with a higher id was exported
+    previous_fingerprints = exported_fingerprints(store_state)
+
+    missed_identifiers = [
+        identifier for identifier in current_fingerprints
+        if identifier not in previous_fingerprints and identifier not in added_identifiers
+    ]
+    updated_identifiers = [
+        identifier for identifier, fingerprint in current_fingerprints.items()
+        if previous_fingerprints.get(identifier) not in (None, fingerprint) and identifier not in added_identifiers
+    ]
+    deleted_identifiers = [identifier for identifier in previous_fingerprints if identifier not in current_fingerprints]
+    return missed_identifiers, updated_identifiers, deleted_identifiers
+
+def updated_rows(rows):
+    for row in rows:
+        yield ['updated'] + list(row)
+
+def deleted_rows(headers, deleted_identifiers):
+    # Jobs that were there at the last export but are not anymore, only their job_identifier is known
+    identifier_index = headers.index('job_identifier')
+    for identifier in deleted_identifiers:
+        row = [None] * len(headers)
+        row[identifier_index] = identifier
+        yield ['deleted'] + row
 
 class Postgresql:
-    def __init__(self, dbname, user, password, host, port):
-        self.conn = psycopg2.connect(
+    def __init__(self, dbname=None, user=None, password=None, host=None, port=None, conn=None):
+        # An open connection (e.g. from the pool of the scheduler) can be passed instead of the credentials
+        self.conn = conn or psycopg2.connect(
             dbname=dbname,
             user=user,
             password=password,
@@ -20,25 +213,90 @@ class Postgresql:
     def fetch_all(self):
         return self.cur.fetchall()
 
+    def stream_query(self, query, itersize=2000, values=None):
+        # A named cursor lives on the server, so the rows are fetched itersize at a time
+        # instead of loading the whole result into memory
+        with self.conn.cursor(name='export_cursor') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, values)
+            for row in cursor:
+                yield row
+
+    def stream_changes(self, table_name, headers, store_state, itersize=2000):
+        # Everything with an id above the high-water mark was inserted since the last export
+        added_identifiers = set()
+        query = f"SELECT * FROM {table_name} WHERE id > %s ORDER BY id;"
+        new_rows = self.stream_query(query, itersize, (store_state.get('last_id', 0),))
+        yield from added_rows(headers, new_rows, store_state, 'id', added_identifiers)
+
+        # The fingerprints are read after the new rows, a row inserted in between is added by its fingerprint
+        query = f"SELECT job_identifier, content_hash FROM {table_name};"
+        current_fingerprints = {identifier: fingerprint for identifier, fingerprint in self.stream_query(query, itersize)}
+        missed_identifiers, updated_identifiers, deleted_identifiers = compare_fingerprints(store_state, current_fingerprints, added_identifiers)
+
+        if missed_identifiers:
+            query = f"SELECT * FROM {table_name} WHERE job_identifier = ANY(%s) ORDER BY id;"
+            yield from added_rows(headers, self.stream_query(query, itersize, (missed_identifiers,)), store_state, None, added_identifiers)
+        store_state['identifiers'] = current_fingerprints
+        if updated_identifiers:
+            query = f"SELECT * FROM {table_name} WHERE job_identifier = ANY(%s) ORDER BY id;"
+            yield from updated_rows(self.stream_query(query, itersize, (updated_identifiers,)))
+        yield from deleted_rows(headers, deleted_identifiers)
+
     def fetch_column_names(self, table_name):
-        query = f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}';"
+        query = f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}' ORDER BY ordinal_position;"
         self.cur.execute(query)
         return [column[0] for column in self.cur.fetchall()]
 
+    def fetch_column_types(self, table_name):
+        # Column types of the table as (data_type, udt_name), udt_name tells the element type of arrays
+        query = "SELECT column_name, data_type, udt_name FROM information_schema.columns WHERE table_name = %s;"
+        self.cur.execute(query, (table_name,))
+        return {column: (data_type, udt_name) for column, data_type, udt_name in self.cur.fetchall()}
+
     def close_connection(self):
         self.cur.close()
         self.conn.close()
 
 class MongoDB:
-    def __init__(self,user, password, dbname, collection_name, host, port):
+    def __init__(self, user=None, password=None, dbname=None, collection_name=None, host=None, port=None, client=None):
+        # An open client can be passed instead of the credentials, like the connection of Postgresql
         self.mongo_uri = f"mongodb://{user}:{password}@{host}:{port}"
-        self.client = MongoClient(self.mongo_uri)
+        self.client = client or MongoClient(self.mongo_uri)
         self.db = self.client[dbname]
         self.collection = self.db[collection_name]
 
     def fetch_all(self):
         return [list(document.values()) for document in self.collection.find()]
 
+    def stream_documents(self, columns, batch_size=2000, filter_query=None, sort=None):
+        # The cursor fetches batch_size documents per round-trip and only the requested columns
+        projection = {column: 1 for column in columns}
+        for document in self.collection.find(filter_query or {}, projection, batch_size=batch_size, sort=sort):
+            yield [document.get(column) for column in columns]
+
+    def stream_changes(self, headers, store_state, batch_size=2000):
+        # ObjectIds grow with the insertion time, so they serve as the high-water mark
+        added_identifiers = set()
+        filter_query = {'_id': {'$gt': ObjectId(store_state['last_id'])}} if store_state.get('last_id') else {}
+        new_rows = self.stream_documents(headers, batch_size, filter_query, [('_id', 1)])
+        yield from added_rows(headers, new_rows, store_state, '_id', added_identifiers)
+        # ObjectId is not JSON serializable
+        if store_state.get('last_id'):
+            store_state['last_id'] = str(store_state['last_id'])
+
+        current_fingerprints = {identifier: fingerprint for identifier, fingerprint in self.stream_documents(['job_identifier', 'content_hash'], batch_size)}
+        missed_identifiers, updated_identifiers, deleted_identifiers = compare_fingerprints(store_state, current_fingerprints, added_identifiers)
+
+        if missed_identifiers:
+            filter_query = {'job_identifier': {'$in': missed_identifiers}}
+            yield from added_rows(headers, self.stream_documents(headers, batch_size, filter_query, [('_id', 1)]), store_state, None, added_identifiers)
+        store_state['identifiers'] = current_fingerprints
+        if updated_identifiers:
+            filter_query = {'job_identifier': {'$in': updated_identifiers}}
+            yield from updated_rows(self.stream_documents(headers, batch_size, filter_query, [('_id', 1)]))
+        yield from deleted_rows(headers, deleted_identifiers)
+
     def fetch_column_names(self):
         # Check if there is at least one document in the collection
         document = self.collection.find_one()
@@ -50,16 +308,15 @@ class MongoDB:
     def close_connection(self):
         self.client.close()
 
-if __name__ == "__main__":
-    # Get the credentials using env variables 
+def connect_databases():
+    # Get the credentials using env variables
     # PostgreSQL credentials
     pg_host = os.getenv('POSTGRES_HOST')
     pg_port = int(os.getenv('POSTGRES_PORT'))
     pg_dbname = os.getenv('POSTGRES_DB')
     pg_user = os.getenv('POSTGRES_USER')
     pg_password = os.getenv('POSTGRES_PASSWORD')
-    pg_table_name = os.getenv('POSTGRES_TABLE_NAME')
-    
+
     # MongoDB credentials
     mongo_host = os.getenv('MONGO_HOST')
     mongo_port = int(os.getenv('MONGO_PORT'))
@@ -67,48 +324,79 @@ if __name__ == "__main__":
     mongo_collection_name = os.getenv('MONGO_COLLECTION_NAME')
     mongo_user = os.getenv('MONGO_USERNAME')
     mongo_password = os.getenv('MONGO_PASSWORD')
-    
+
     # Instantiate Database and MongoDB classes
     pg_db = Postgresql(pg_dbname, pg_user, pg_password, pg_host, pg_port)
     mongo_db = MongoDB(mongo_user, mongo_password, mongo_dbname, mongo_collection_name, mongo_host, mongo_port)
+    return pg_db, mongo_db
+
+def run_export(pg_db, mongo_db, export_format='csv', incremental=False, pg_table_name=None, output_prefix='output_data', state_filename=None):
+    # Export both stores with already open connections, so a long-running process can reuse them.
+    # A multi-site run exports every site from its own table to its own files
+    pg_table_name = pg_table_name or os.getenv('POSTGRES_TABLE_NAME')
+
+    # Number of rows fetched from the databases per round-trip
+    batch_size = int(os.getenv('EXPORT_BATCH_SIZE', 2000))
+
+    # The high-water marks and identifiers of the last incremental export
+    state_filename = state_filename or os.getenv('EXPORT_STATE_FILE', 'export_state.json')
+    state = load_export_state(state_filename) if incremental else {}
 
     # PostgreSQL
     pg_csv_headers = pg_db.fetch_column_names(pg_table_name)
-    pg_query = f"SELECT * FROM {pg_table_name};"
-    pg_db.execute_query(pg_query)
-    pg_data = pg_db.fetch_all()
+    pg_column_types = pg_db.fetch_column_types(pg_table_name)
 
-    # CSV file configuration for PostgreSQL
-    pg_csv_filename = "output_data_pg.csv"
+    if incremental:
+        # Change log of the added and deleted rows for PostgreSQL
+        pg_changes = pg_db.stream_changes(pg_table_name, pg_csv_headers, state.setdefault('postgresql', {}), batch_size)
+        pg_csv_filename = export_rows(export_format, f"{output_prefix}_pg_changes", ['change'] + pg_csv_headers, pg_changes, pg_column_types, append=True)
+    else:
+        pg_query = f"SELECT * FROM {pg_table_name};"
 
-    # Clear existing file if it exists
-    if os.path.exists(pg_csv_filename):
-        os.remove(pg_csv_filename)
-
-    with open(pg_csv_filename, 'w', newline='') as pg_csv_file:
-        pg_csv_writer = csv.writer(pg_csv_file)
-        pg_csv_writer.writerow(pg_csv_headers)
-        pg_csv_writer.writerows(pg_data)
+        # Export file configuration for PostgreSQL
+        pg_csv_filename = export_rows(export_format, f"{output_prefix}_pg", pg_csv_headers, pg_db.stream_query(pg_query, batch_size), pg_column_types)
 
+    # End the read transaction, an idle connection must not keep it open until the next export
+    pg_db.conn.commit()
     print(f"PostgreSQL data has been exported to {pg_csv_filename}")
 
     # MongoDB
-    mongo_csv_headers = mongo_db.fetch_column_names()
-    mongo_data = mongo_db.fetch_all()
+    # The documents leave out the fields a job does not have, so the columns are those of the PostgreSQL
+    # table, the JobItem fields in a fixed order, rather than the keys of whichever document comes first
+    if pg_csv_headers:
+        mongo_csv_headers = ['_id'] + [column for column in pg_csv_headers if column != 'id']
+    else:
+        mongo_csv_headers = mongo_db.fetch_column_names()
+    # The documents hold the values as they came from the API and are not converted to the column
+    # types like in PostgreSQL, so only the array columns are typed and everything else is kept as text
+    mongo_column_types = {column: column_type for column, column_type in pg_column_types.items() if column_type[0] == 'ARRAY'}
 
-    # CSV file configuration for MongoDB
-    mongo_csv_filename = "output_data_mongo.csv"
+    if incremental:
+        # Change log of the added and deleted documents for MongoDB, nothing to do for an empty collection
+        mongo_csv_filename = f"{output_prefix}_mongo_changes"
+        if mongo_csv_headers:
+            mongo_changes = mongo_db.stream_changes(mongo_csv_headers, state.setdefault('mongodb', {}), batch_size)
+            mongo_csv_filename = export_rows(export_format, mongo_csv_filename, ['change'] + mongo_csv_headers, mongo_changes, mongo_column_types, append=True)
+    else:
+        # Export file configuration for MongoDB
+        mongo_rows = mongo_db.stream_documents(mongo_csv_headers, batch_size)
+        mongo_csv_filename = export_rows(export_format, f"{output_prefix}_mongo", mongo_csv_headers, mongo_rows, mongo_column_types)
 
-    # Clear existing file if it exists
-    if os.path.exists(mongo_csv_filename):
-        os.remove(mongo_csv_filename)
+    print(f"MongoDB data has been exported to {mongo_csv_filename}")
 
-    with open(mongo_csv_filename, 'w', newline='') as mongo_csv_file:
-        mongo_csv_writer = csv.writer(mongo_csv_file)
-        mongo_csv_writer.writerow(mongo_csv_headers)
-        mongo_csv_writer.writerows(mongo_data)
+    if incremental:
+        save_export_state(state_filename, state)
 
-    print(f"MongoDB data has been exported to {mongo_csv_filename}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the job postings from PostgreSQL and MongoDB to CSV files.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only append the jobs added, updated or deleted since the last incremental export to the change log files")
+    parser.add_argument('--format', choices=sorted(EXPORT_WRITERS), default=os.getenv('EXPORT_FORMAT', 'csv'),
+                        help="Format of the exported files, parquet needs pyarrow")
+    args = parser.parse_args()
+
+    pg_db, mongo_db = connect_databases()
+    run_export(pg_db, mongo_db, args.format, args.incremental)
 
     # Close the database connections
     pg_db.close_connection()
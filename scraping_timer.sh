@@ -8,7 +8,7 @@ NC='\033[0m'  # No color
 
 while true; do
   echo -e "${GREEN}Running scraper at $(date)${NC}"
-  scrapy crawl job_spider && python ../query.py
+  scrapy crawl job_spider && python ../query.py --incremental
   if [ $? -eq 0 ]; then
     echo -e "${GREEN}Scraping successful at $(date)${NC}"
   else